@@ -627,12 +627,23 @@ class Cluster(object):
 
 
     def vp_index(self):
+        """ VP index of the last atom (the center in cluster files), see voropp.cluster_index. """
         if not hasattr(self, '_vp_index'):
-            from voropp import compute_index
-            self._vp_index = compute_index(self.filename)
+            from voropp import cluster_index
+            self._vp_index = cluster_index(self.positions)
         return self._vp_index
 
 
+    @staticmethod
+    def vp_indexes(clusters, nprocs=1):
+        """ Computes the vp_index of many clusters in one call (optionally with nprocs processes). """
+        from voropp import compute_indexes
+        todo = [cluster for cluster in clusters if not hasattr(cluster, '_vp_index')]
+        for cluster,index in zip(todo, compute_indexes([cluster.positions for cluster in todo], nprocs=nprocs)):
+            cluster._vp_index = index
+        return [cluster._vp_index for cluster in clusters]
+
+
     @staticmethod
     def _rescale_coordinates(coordinates, scale):
         return coordinates * scale
@@ -3,12 +3,15 @@ import copy
 
 class VoronoiPoly(object):
     """ A structure for holding the Voronoi Polyhedron surrounding an atom. """
+    __slots__ = ('index', 'type', 'nnabsp', 'neighs', 'volume', 'vol')
+
     def __init__(self, index=None, type=None, nnabsp=None, neighs=None, volume=None):
         self.index = index # List
         self.type = type # User defined string, e.g. 'Crystal-like'
         self.nnabsp = nnabsp # Dictionary
         self.neighs = neighs # List of this atoms neighbors
         self.volume = volume # Float
+        self.vol = None # Float, set by voronoi_3d
 
     def copy(self):
         new = VoronoiPoly()
@@ -17,6 +20,7 @@ class VoronoiPoly(object):
         new.nnabsp = copy.copy(self.nnabsp)
         new.neighs = copy.copy(self.neighs)
         new.volume = self.volume
+        new.vol = self.vol
         return new
 
     def compute_type(self, vp_dict):
@@ -39,6 +43,9 @@ class VoronoiPoly(object):
         return '<{0}>'.format(' '.join(str(x) for x in self.index))
 
 class Atom(object):
+    # 'intensity' is set by ift_atom_selection
+    __slots__ = ('id', 'z', 'coord', '_vp', 'neighs', 'cn', 'intensity')
+
     def __init__(self, id, znum, x, y, z):
         self.id = id
         if(isinstance(znum,int)):
@@ -46,10 +53,23 @@ class Atom(object):
         elif(isinstance(znum,str)):
             self.z = znum2sym.sym2z(znum)
         self.coord = (x,y,z)
-        self.vp = VoronoiPoly()
+        self._vp = None # Created on first access, see vp
         self.neighs = None # Neighbors. List when set
         self.cn = None # Coordination number. int when set
-        self.sym = znum2sym.z2sym(self.z) #atomic symbol
+
+    @property
+    def vp(self):
+        if self._vp is None:
+            self._vp = VoronoiPoly()
+        return self._vp
+    @vp.setter
+    def vp(self, vp):
+        self._vp = vp
+
+    @property
+    def sym(self):
+        """ Atomic symbol, shared from the znum2sym table rather than stored per atom. """
+        return znum2sym.atomid[self.z]
 
     def __eq__(self, other):
         x,y,z = [round(xx,6) for xx in self.coord]
@@ -59,7 +79,8 @@ class Atom(object):
 
     def copy(self):
         new = Atom(self.id, self.z, self.coord[0], self.coord[1], self.coord[2])
-        new.vp = self.vp.copy()
+        if self._vp is not None:
+            new._vp = self._vp.copy()
         new.neighs = copy.copy(self.neighs)
         new.cn = self.cn
         return new
@@ -0,0 +1,330 @@
+import copy
+import numpy as np
+import znum2sym
+from atom import Atom, VoronoiPoly
+
+VP_INDEX_LENGTH = 8 # <n3,n4,...,n10>, the same length voronoi_3d produces
+
+
+class ArrayVoronoiPoly(object):
+    """ A VoronoiPoly whose index and volume live in the arrays of an AtomArrays.
+        The remaining (rarely used) fields are kept in a small per-atom dictionary. """
+    __slots__ = ('_arrays', '_slot')
+    _extra_fields = ('type', 'nnabsp', 'neighs', 'volume')
+
+    def __init__(self, arrays, slot):
+        self._arrays = arrays
+        self._slot = slot
+
+    @property
+    def index(self):
+        row = self._arrays._vp_index[self._slot]
+        if row[0] < 0:
+            return None
+        return tuple(int(x) for x in row if x >= 0)
+    @index.setter
+    def index(self, index):
+        row = self._arrays._vp_index[self._slot]
+        row[:] = -1
+        if index is None:
+            return
+        if len(index) > VP_INDEX_LENGTH:
+            raise ValueError("VP index {0} is longer than {1}.".format(index, VP_INDEX_LENGTH))
+        row[:len(index)] = index
+
+    @property
+    def vol(self):
+        vol = self._arrays._vp_vol[self._slot]
+        if np.isnan(vol):
+            return None
+        return float(vol)
+    @vol.setter
+    def vol(self, vol):
+        self._arrays._vp_vol[self._slot] = np.nan if vol is None else vol
+
+    def __getattr__(self, key):
+        if key in ArrayVoronoiPoly._extra_fields:
+            return self._arrays._vp_extra.get(self._slot, {}).get(key)
+        raise AttributeError(key)
+
+    def __setattr__(self, key, value):
+        if key in ArrayVoronoiPoly._extra_fields:
+            self._arrays._vp_extra.setdefault(self._slot, {})[key] = value
+        else:
+            object.__setattr__(self, key, value)
+
+    def copy(self):
+        new = VoronoiPoly(index=self.index, type=self.type, nnabsp=copy.copy(self.nnabsp),
+                          neighs=copy.copy(self.neighs), volume=self.volume)
+        new.vol = self.vol
+        return new
+
+    def compute_type(self, vp_dict):
+        return VoronoiPoly.compute_type(self, vp_dict)
+
+    def __repr__(self):
+        return VoronoiPoly.__repr__(self)
+    def __str__(self):
+        return VoronoiPoly.__str__(self)
+
+
+class AtomView(object):
+    """ A lightweight stand-in for Atom. It holds no data itself; every attribute
+        is read from and written to the arrays of its parent AtomArrays. """
+    __slots__ = ('_arrays', '_slot')
+
+    def __init__(self, arrays, slot):
+        self._arrays = arrays
+        self._slot = slot
+
+    @property
+    def id(self):
+        return int(self._arrays._ids[self._slot])
+    @id.setter
+    def id(self, id):
+        self._arrays._ids[self._slot] = id
+
+    @property
+    def z(self):
+        return int(self._arrays._znums[self._slot])
+    @z.setter
+    def z(self, znum):
+        self._arrays._znums[self._slot] = znum
+
+    @property
+    def coord(self):
+        return tuple(self._arrays._positions[self._slot].tolist())
+    @coord.setter
+    def coord(self, coord):
+        self._arrays._positions[self._slot] = coord
+
+    @property
+    def sym(self):
+        return znum2sym.z2sym(self.z)
+
+    @property
+    def cn(self):
+        cn = self._arrays._cn[self._slot]
+        if cn < 0:
+            return None
+        return int(cn)
+    @cn.setter
+    def cn(self, cn):
+        self._arrays._cn[self._slot] = -1 if cn is None else cn
+
+    @property
+    def neighs(self):
+        return self._arrays._neighs[self._slot]
+    @neighs.setter
+    def neighs(self, neighs):
+        self._arrays._neighs[self._slot] = neighs
+
+    @property
+    def vp(self):
+        return ArrayVoronoiPoly(self._arrays, self._slot)
+    @vp.setter
+    def vp(self, vp):
+        new = ArrayVoronoiPoly(self._arrays, self._slot)
+        new.index = vp.index
+        new.vol = getattr(vp, 'vol', None)
+        for key in ArrayVoronoiPoly._extra_fields:
+            setattr(new, key, getattr(vp, key))
+
+    def __eq__(self, other):
+        return Atom.__eq__(self, other)
+
+    def copy(self):
+        """ Returns a standalone Atom with the same data as this view. """
+        new = Atom(self.id, self.z, *self.coord)
+        new.vp = self.vp.copy()
+        new.neighs = None if self.neighs is None else list(self.neighs)
+        new.cn = self.cn
+        return new
+
+    def __repr__(self):
+        return 'atomID={0}'.format(self.id)
+
+    def realxyz(self):
+        """ Prints the atom in xyz file format. """
+        return Atom.realxyz(self)
+
+
+class AtomArrays(object):
+    """ Structure-of-arrays storage for the atoms of a model.
+        The arrays `positions` (N,3), `znums`, `ids`, `cn` and `vp_index` (N,8)
+        are contiguous numpy arrays that vectorized code can use directly.
+        Indexing returns AtomView objects so that code written for a list of
+        Atoms (e.g. model.atoms[i].coord) keeps working. """
+
+    def __init__(self, ids=None, znums=None, positions=None):
+        if positions is None:
+            positions = np.zeros((0,3), dtype=float)
+        positions = np.asarray(positions, dtype=float).reshape((-1,3))
+        n = len(positions)
+        if ids is None:
+            ids = np.arange(n)
+        if znums is None:
+            znums = np.zeros(n, dtype=int)
+        self._n = 0
+        self._allocate(n)
+        self._n = n
+        self._positions[:n] = positions
+        self._znums[:n] = znums
+        self._ids[:n] = ids
+
+    @classmethod
+    def from_atoms(cls, atoms):
+        """ Creates an AtomArrays holding copies of the data in 'atoms'. """
+        atoms = list(atoms)
+        new = cls(ids=[atom.id for atom in atoms],
+                  znums=[atom.z for atom in atoms],
+                  positions=[atom.coord for atom in atoms])
+        for i,atom in enumerate(atoms):
+            if atom.cn is not None or atom.neighs is not None:
+                new._cn[i] = -1 if atom.cn is None else atom.cn
+                new._neighs[i] = atom.neighs
+            vp = atom._vp if isinstance(atom, Atom) else atom.vp # don't create unused VPs
+            if vp is not None and vp.index is not None:
+                new[i].vp = vp
+        return new
+
+    def _allocate(self, capacity):
+        """ (Re)allocates the arrays to hold 'capacity' atoms, keeping the first self._n. """
+        n = self._n
+        def grow(old, shape, dtype, fill):
+            new = np.full(shape, fill, dtype=dtype)
+            if old is not None:
+                new[:n] = old[:n]
+            return new
+        self._positions = grow(getattr(self, '_positions', None), (capacity,3), float, 0.0)
+        self._znums = grow(getattr(self, '_znums', None), capacity, int, 0)
+        self._ids = grow(getattr(self, '_ids', None), capacity, int, 0)
+        self._cn = grow(getattr(self, '_cn', None), capacity, int, -1)
+        self._vp_index = grow(getattr(self, '_vp_index', None), (capacity,VP_INDEX_LENGTH), int, -1)
+        self._vp_vol = grow(getattr(self, '_vp_vol', None), capacity, float, np.nan)
+        neighs = getattr(self, '_neighs', [])
+        self._neighs = neighs[:n] + [None]*(capacity-n)
+        if not hasattr(self, '_vp_extra'):
+            self._vp_extra = {}
+
+    @property
+    def positions(self):
+        return self._positions[:self._n]
+    @property
+    def znums(self):
+        return self._znums[:self._n]
+    @property
+    def ids(self):
+        return self._ids[:self._n]
+    @property
+    def cn(self):
+        return self._cn[:self._n]
+    @property
+    def vp_index(self):
+        return self._vp_index[:self._n]
+    @property
+    def vp_vol(self):
+        return self._vp_vol[:self._n]
+
+    def __len__(self):
+        return self._n
+
+    def _check_slot(self, i):
+        if i < 0:
+            i += self._n
+        if not 0 <= i < self._n:
+            raise IndexError("atom index out of range")
+        return i
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [AtomView(self, j) for j in range(*i.indices(self._n))]
+        return AtomView(self, self._check_slot(i))
+
+    def __setitem__(self, i, atom):
+        """ Copies the data of 'atom' into slot i. """
+        i = self._check_slot(i)
+        if isinstance(atom, AtomView):
+            atom = atom.copy()
+        self._set_slot(i, atom)
+
+    def _set_slot(self, i, atom):
+        self._positions[i] = atom.coord
+        self._znums[i] = atom.z
+        self._ids[i] = atom.id
+        self._cn[i] = -1 if atom.cn is None else atom.cn
+        self._neighs[i] = atom.neighs
+        self._vp_extra.pop(i, None)
+        AtomView(self, i).vp = atom.vp
+
+    def __iter__(self):
+        for i in range(self._n):
+            yield AtomView(self, i)
+
+    def __contains__(self, atom):
+        try:
+            self.index(atom)
+        except ValueError:
+            return False
+        return True
+
+    def index(self, atom):
+        """ Returns the slot of the first atom equal to 'atom' (see Atom.__eq__). """
+        coord = np.round(np.asarray(atom.coord, dtype=float), 6)
+        match = (self.znums == atom.z) & np.all(np.round(self.positions, 6) == coord, axis=1)
+        found = np.flatnonzero(match)
+        if len(found) == 0:
+            raise ValueError("{0} is not in the model".format(atom))
+        return int(found[0])
+
+    def append(self, atom):
+        if self._n == len(self._ids):
+            self._allocate(max(2*self._n, 16))
+        self._n += 1
+        self._set_slot(self._n-1, atom)
+
+    def extend(self, atoms):
+        for atom in atoms:
+            self.append(atom)
+
+    def remove(self, atom):
+        """ Removes the first atom equal to 'atom'. Atoms after it shift down one slot,
+            so AtomViews obtained before the removal should not be reused. """
+        i = self.index(atom)
+        n = self._n
+        for arr in (self._positions, self._znums, self._ids, self._cn, self._vp_index, self._vp_vol):
+            arr[i:n-1] = arr[i+1:n]
+        del self._neighs[i]
+        self._neighs.append(None)
+        self._vp_extra = dict((j if j < i else j-1, v) for j,v in self._vp_extra.items() if j != i)
+        self._n -= 1
+
+    def swap_remove(self, i):
+        """ Removes slot i by moving the last atom into it. Only the views of slot i
+            and of the last slot are affected. """
+        i = self._check_slot(i)
+        last = self._n - 1
+        for arr in (self._positions, self._znums, self._ids, self._cn, self._vp_index, self._vp_vol):
+            arr[i] = arr[last]
+        self._neighs[i] = self._neighs[last]
+        self._neighs[last] = None
+        self._vp_extra.pop(i, None)
+        if last in self._vp_extra:
+            self._vp_extra[i] = self._vp_extra.pop(last)
+        self._n -= 1
+
+    def compress(self, keep):
+        """ Keeps only the slots where the boolean array 'keep' is True, in order. """
+        keep = np.asarray(keep, dtype=bool)
+        m = int(keep.sum())
+        slots = np.flatnonzero(keep)
+        for arr in (self._positions, self._znums, self._ids, self._cn, self._vp_index, self._vp_vol):
+            arr[:m] = arr[slots]
+        self._neighs = [self._neighs[j] for j in slots.tolist()] + [None]*(len(self._neighs)-m)
+        new_slot = dict(zip(slots.tolist(), range(m)))
+        self._vp_extra = dict((new_slot[j], v) for j,v in self._vp_extra.items() if j in new_slot)
+        self._n = m
+
+    def to_atoms(self):
+        """ Returns a list of standalone Atom objects. """
+        return [atom.copy() for atom in self]
@@ -0,0 +1,117 @@
+""" Times the Voronoi backends on one model and compares their VP indexes with the
+    periodic scipy tessellation.
+    usage: python benchmark_voronoi.py modelfile cutoff [nprocs] [nsample]
+    The fortran backend runs the vorv4 executable given by $VORV4 (or found on the PATH)
+    and the voro++ backend runs 'voronoi'; either is skipped if its executable is not
+    available. voro++ runs once per atom, so it only does the first nsample atoms. """
+import sys
+import os
+import time
+import tempfile
+import contextlib
+import numpy as np
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+from model import Model
+import voronoi_3d
+import voronoi_scipy
+import voronoi_fortran
+import voropp
+import znum2sym
+
+@contextlib.contextmanager
+def quiet():
+    """ Silences the progress printing of the backends. """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def run_voronoi_3d(modelfile, cutoff, nprocs=1, engine='numpy'):
+    m = Model(modelfile)
+    m.generate_neighbors(cutoff)
+    with quiet():
+        voronoi_3d.vp_anaysizesis(m, cutoff, 0.03, 0.03, 0.03, nprocs=nprocs, engine=engine, cache=False)
+    return np.array([atom.vp.index for atom in m.atoms])
+
+
+def run_scipy(modelfile, cutoff):
+    m = Model(modelfile)
+    return voronoi_scipy.tessellate(m).index
+
+
+def run_fortran(modelfile, cutoff):
+    with quiet():
+        m = voronoi_fortran.fortran_voronoi_3d(modelfile, cutoff, cache=False)
+    return np.array([atom.vp.index for atom in m.atoms])
+
+
+def run_voropp(modelfile, cutoff, nsample):
+    """ Writes the neighbors within cutoff of each of the first nsample atoms, with the
+        atom itself last, to a cluster file and runs voro++ on it. """
+    m = Model(modelfile)
+    m.generate_neighbors(cutoff)
+    nl = m.neighbor_list
+    positions = m.positions
+    syms = [znum2sym.z2sym(z) for z in m.znums.tolist()]
+    index = []
+    fd, filename = tempfile.mkstemp(suffix='.xyz')
+    os.close(fd)
+    try:
+        for n in range(min(nsample, m.natoms)):
+            neighs = nl[n]
+            coords = m.minimum_image(positions[neighs] - positions[n])
+            with open(filename, 'w') as f:
+                f.write('{0}\ncluster of atom {1}\n'.format(len(neighs)+1, n))
+                for x,(cx,cy,cz) in zip(neighs.tolist(), coords.tolist()):
+                    f.write('{0} {1} {2} {3}\n'.format(syms[x], cx, cy, cz))
+                f.write('{0} 0.0 0.0 0.0\n'.format(syms[n]))
+            with quiet():
+                index.append(voropp.compute_index(filename)[:8])
+    finally:
+        os.remove(filename)
+    return np.array(index)
+
+
+def main():
+    modelfile = sys.argv[1]
+    cutoff = float(sys.argv[2])
+    nprocs = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    nsample = int(sys.argv[4]) if len(sys.argv) > 4 else 100
+
+    backends = [('scipy', lambda: run_scipy(modelfile, cutoff)),
+                ('voronoi_3d (python)', lambda: run_voronoi_3d(modelfile, cutoff, engine='python')),
+                ('voronoi_3d (numpy)', lambda: run_voronoi_3d(modelfile, cutoff))]
+    if nprocs > 1:
+        backends.append(('voronoi_3d (numpy, {0} procs)'.format(nprocs), lambda: run_voronoi_3d(modelfile, cutoff, nprocs=nprocs)))
+    vorv4 = os.environ.get('VORV4') or which('vorv4')
+    if vorv4 and os.path.exists(vorv4):
+        voronoi_fortran.VORV4 = vorv4
+        backends.append(('fortran', lambda: run_fortran(modelfile, cutoff)))
+    else:
+        print("Skipping fortran: set VORV4 to the vorv4 executable")
+    if which('voronoi'):
+        backends.append(('voro++ ({0} atoms)'.format(nsample), lambda: run_voropp(modelfile, cutoff, nsample)))
+    else:
+        print("Skipping voro++: voronoi executable not found")
+
+    reference = None
+    print("{0:<32}{1:>12}{2:>16}".format('backend', 'seconds', 'same as scipy'))
+    for name,run in backends:
+        start = time.time()
+        index = run()
+        seconds = time.time() - start
+        if reference is None:
+            reference = index
+        same = np.all(index == reference[:len(index)], axis=1).mean()
+        print("{0:<32}{1:>12.3f}{2:>15.1f}%".format(name, seconds, 100.0*same))
+
+
+if __name__ == '__main__':
+    main()
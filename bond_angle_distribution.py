@@ -0,0 +1,71 @@
+import numpy as np
+
+
+def triplet_angles(m, chunksize=1000000):
+    """ Generator over the bond angles j-i-k of every atom i and every pair of its
+        neighbors j < k (positions in the neighbor list of i), in chunks of roughly
+        'chunksize' triplets. Each chunk is (centers, j, k, theta) where theta is in radians.
+        Centers with the same coordination number are handled together: their
+        minimum-image bond vectors form a (ncenters, cn, 3) array and all the angles
+        come from one batched dot product. """
+    nl = m.get_neighbor_list()
+    counts = nl.counts
+    if nl.vectors is not None:
+        vectors = np.asarray(nl.vectors, dtype=float)
+    else:
+        vectors, _ = m.dist_pairs(nl.centers(), nl.indices)
+    lengths = np.sqrt(np.einsum('ij,ij->i', vectors, vectors))
+    units = vectors/np.where(lengths > 0, lengths, 1.0)[:,None]
+    for cn in np.unique(counts):
+        if cn < 2:
+            continue
+        centers = np.flatnonzero(counts == cn)
+        a, b = np.triu_indices(cn, k=1)
+        step = max(chunksize//len(a), 1)
+        for start in range(0, len(centers), step):
+            chunk = centers[start:start+step]
+            rows = nl.offsets[chunk][:,None] + np.arange(cn)
+            u = units[rows]
+            cos = np.einsum('nad,nbd->nab', u, u)[:,a,b]
+            theta = np.arccos(np.clip(cos, -1.0, 1.0))
+            yield (np.repeat(chunk, len(a)), nl.indices[rows[:,a]].ravel(),
+                   nl.indices[rows[:,b]].ravel(), theta.ravel())
+
+
+def bad(m, nbins=None, dtheta=None, partial=False, chunksize=1000000):
+    """ Bond angle distribution of model m, which needs neighbors (e.g. from
+        m.generate_neighbors). Give either nbins or dtheta (radians).
+        Returns (angles, hist): the left edge of every bin in degrees (nbins+1 of them,
+        the last one only catches angles of exactly 180) and the number of angles in
+        every bin. If partial is True hist is a dictionary keyed by (zi, zj, zk), the
+        elements of the center atom i and its two neighbors with zj <= zk. """
+    if nbins is None and dtheta is None:
+        raise Exception("Either nbins or dtheta must be specified.")
+    if nbins is None:
+        nbins = int(round(np.pi/dtheta))
+    elif dtheta is None:
+        dtheta = np.pi/nbins
+    else:
+        raise Exception("Either nbins or dtheta must be specified.")
+    znums = m.znums
+    species, types = np.unique(znums, return_inverse=True)
+    nspecies = len(species)
+    nkinds = nspecies**3 if partial else 1
+    hist = np.zeros(nkinds*(nbins+1), dtype=int)
+    for centers, j, k, theta in triplet_angles(m, chunksize):
+        bins = np.minimum((np.round(theta, 10)/dtheta).astype(int), nbins)
+        if partial:
+            tj, tk = types[j], types[k]
+            kind = (types[centers]*nspecies + np.minimum(tj,tk))*nspecies + np.maximum(tj,tk)
+            bins = kind*(nbins+1) + bins
+        hist += np.bincount(bins, minlength=len(hist))
+    angles = np.arange(nbins+1)*dtheta*180.0/np.pi
+    if not partial:
+        return angles, hist
+    hist = hist.reshape((nspecies, nspecies, nspecies, nbins+1))
+    partials = {}
+    for a in range(nspecies):
+        for b in range(nspecies):
+            for c in range(b, nspecies):
+                partials[(int(species[a]), int(species[b]), int(species[c]))] = hist[a,b,c]
+    return angles, partials
@@ -1,40 +1,34 @@
 import sys
-import copy
 from model import Model
-from vor import fortran_voronoi_3d
-from voronoi_3d import voronoi_3d
+from cutoff_sweep import CutoffSweep
 
 def cn_histo(m):
     d = {}
     for atom in m.atoms:
         d[sum(atom.vp.index)] = d.get(sum(atom.vp.index),0) + 1
-    l = d.keys()
-    l.sort()
-    for key in l:
+    for key in sorted(d):
         print("{0} {1}".format(key,d[key]))
 
 def main():
     modelfile = sys.argv[1]
 
     m = Model(modelfile)
-    keys = [(41,41),(28,28),(41,28)]
-    cutoff = {}
-    cutoff[(41,41)] = 3.5
-    cutoff[(28,28)] = 3.5
-    cutoff[(41,28)] = 3.5
+    keys = [(41,41),(28,28),(41,28),(28,41)]
 
+    cutoffs = []
     #for dc in [-0.3, -0.2, 0.0, -0.1, 0.1, 0.2, 0.3]:
     for c in [3.3, 3.4, 3.5, 3.6, 3.7, 3.8, 3.9, 4.0, 4.1, 4.2, 4.3, 4.4, 4.5]:
-        cutoff2 = copy.deepcopy(cutoff)
-        m = Model(modelfile)
+        cutoff = {}
         for key in keys:
-            cutoff2[key] = c
-        try:
-            voronoi_3d(m,cutoff2)
-            print("Cutoff = {0}".format(c))
-            cn_histo(m)
-        except:
-            pass
+            cutoff[key] = c
+        cutoffs.append(cutoff)
+
+    # One neighbor search at the largest cutoff; VPs are only recomputed
+    # for the atoms whose neighbors change from one cutoff to the next.
+    sweep = CutoffSweep(m, cutoffs)
+    for cutoff,changed in sweep.voronoi():
+        print("Cutoff = {0}".format(cutoff[keys[0]]))
+        cn_histo(m)
 
 
 if __name__ == '__main__':
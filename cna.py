@@ -9,6 +9,15 @@ def allcna(m):
     """ Common neighbor analysis """
 
     cna = defaultdict(list)
+    nl = m._valid_neighbor_list()
+    if nl is not None:
+        for i,atom in enumerate(m.atoms):
+            if(nl.counts[i] == 0):
+                raise Exception("m.generate_neighbors() must be run before calling allcna")
+            for j in nl[i]:
+                type = one_cna_nl(nl,i,j)
+                cna[type] += (atom,m.atoms[j])
+        return cna
     for atom in m.atoms:
         #print(atom)
         #print(atom.neighs)
@@ -19,6 +28,28 @@ def allcna(m):
             cna[type] += (atom,n)
     return cna
 
+def one_cna_nl(nl,i,j):
+    """ Same as one_cna but works on atom indexes using the sorted rows of
+        a NeighborList (see Model.generate_neighbors) """
+    cna = [0,0,0]
+    cnl = nl.common(i,j).tolist()
+    cna[0] = len(cnl)
+    common_neighs = dict((x,[]) for x in cnl)
+    for a,x in enumerate(cnl):
+        for y in cnl[a+1:]:
+            if nl.contains(y,x):
+                common_neighs[x].append(y)
+                common_neighs[y].append(x)
+                cna[1] += 1
+
+    longestpath = 0
+    for cn in common_neighs:
+        lpath,lp = temp(common_neighs, common_neighs[cn], [cn], 0, 0, [cn])
+        if( nl.contains(lpath[-1],lpath[0]) and lp > 1): lp += 1 # found a cycle
+        if(lp > longestpath): longestpath = lp
+    cna[2] = longestpath
+    return tuple(cna)
+
 def one_cna(atom1,atom2):
     cna = [0,0,0]
     # Calculate the number of neighbors they have in common
@@ -1,3 +1,5 @@
+import numpy as np
+
 cutoff = {}
 # Zr Cu Al
 cutoff[(40,40)] = 3.6
@@ -27,3 +29,15 @@ cutoff[(13,13)] = 3.8
 cutoff[(62,62)] = 3.8
 cutoff[(13,62)] = 3.8
 cutoff[(62,13)] = 3.8
+
+
+def cutoff_matrix(cutoff, zmax=118):
+    """ Converts a cutoff (a float or a dictionary keyed by (z1,z2) like the one above)
+        into a dense (zmax+1)x(zmax+1) matrix indexed by atomic number.
+        Pairs that are not in the dictionary get a cutoff of 0, i.e. they are never neighbors. """
+    if not isinstance(cutoff, dict):
+        return np.full((zmax+1,zmax+1), float(cutoff))
+    mat = np.zeros((zmax+1,zmax+1))
+    for (z1,z2),r in cutoff.items():
+        mat[z1,z2] = r
+    return mat
@@ -0,0 +1,123 @@
+import numpy as np
+from cutoff import cutoff_matrix
+from neighbor_list import NeighborList
+import voronoi_3d
+import vp_cache
+
+
+class CutoffSweep(object):
+    """ Neighbor data of a model for a series of cutoffs, from a single neighbor search at
+        the largest cutoff. Each cutoff can be a float or a dictionary keyed by (z1,z2) with
+        the same meaning as in Model.generate_neighbors.
+        The pairs are sorted by center atom, neighbor element and distance, so for every
+        cutoff the neighbors of an atom of each element are a prefix of its group and the
+        (partial) coordination numbers are found with one searchsorted per cutoff. """
+
+    def __init__(self, model, cutoffs):
+        self.model = model
+        self.cutoffs = list(cutoffs)
+        znums = model.znums
+        self.species, types = np.unique(znums, return_inverse=True)
+        nspecies = len(self.species)
+        tables = [cutoff_matrix(c)[np.ix_(self.species, self.species)] for c in self.cutoffs]
+        rmax = max(table.max() for table in tables)
+        i, j, d = model.hutch.get_all_neighbors(float(rmax))
+        # Groups are (center, neighbor element); sort by group then distance
+        group = i*nspecies + types[j]
+        order = np.lexsort((d, group))
+        self.i, self.j, self.d, group = i[order], j[order], d[order], group[order]
+        ngroups = model.natoms*nspecies
+        self._starts = np.searchsorted(group, np.arange(ngroups+1))
+        self._rank = np.arange(len(group)) - self._starts[group]
+        # The distances of all groups in one increasing array, so a cutoff is a searchsorted
+        width = float(rmax) + 1.0
+        self._key = group*width + self.d
+        self._width = width
+        self._tables = tables
+        self._types = types
+        self._counts = {}
+
+    def __len__(self):
+        return len(self.cutoffs)
+
+    def group_counts(self, k):
+        """ (natoms,nspecies) array of the number of neighbors of each element around every atom at cutoff k. """
+        if k not in self._counts:
+            nspecies = len(self.species)
+            natoms = self.model.natoms
+            # Cutoff of every (center, neighbor element) group, following Model.generate_neighbors
+            cut = self._tables[k][:, self._types].T # [center, neighbor element]
+            groups = np.arange(natoms*nspecies)
+            # A neighbor is kept if d < cut, matching the strict comparison in Hutch.get_all_neighbors
+            ends = np.searchsorted(self._key, groups*self._width + cut.ravel(), side='left')
+            self._counts[k] = (ends - self._starts[:-1]).reshape((natoms,nspecies))
+        return self._counts[k]
+
+    def coordination(self, k):
+        """ Returns (cn, partial) at cutoff k: the coordination number of every atom and the
+            (natoms,nspecies) partial coordination numbers (columns follow self.species). """
+        partial = self.group_counts(k)
+        return partial.sum(axis=1), partial
+
+    def neighbors(self, k):
+        """ Returns the NeighborList at cutoff k. """
+        counts = self.group_counts(k).ravel()
+        nspecies = len(self.species)
+        keep = self._rank < counts[self.i*nspecies + self._types[self.j]]
+        i, j, d = self.i[keep], self.j[keep], self.d[keep]
+        order = np.lexsort((j, i))
+        return NeighborList.from_pairs(self.model.natoms, i[order], j[order], d[order])
+
+    def changed(self, k):
+        """ Indices of the atoms whose neighbors at cutoff k differ from those at cutoff k-1
+            (every atom for k = 0). """
+        if k == 0:
+            return np.arange(self.model.natoms)
+        return np.flatnonzero(np.any(self.group_counts(k) != self.group_counts(k-1), axis=1))
+
+    def voronoi(self, atol=0.03, tol=0.03, tltol=0.03, cache=None):
+        """ Generator that sets atom.neighs, atom.cn and atom.vp of the model for each cutoff
+            in turn and yields (cutoff, changed) after each one, where changed are the atoms
+            whose neighbors, and therefore VP, were recomputed. The VPs of the other atoms
+            are kept from the previous cutoff. A ModelView gets its own copies of the
+            atoms first.
+            If the VP of an atom fails at some cutoff (e.g. MyError or a face with too many
+            edges), that cutoff is reported and skipped, and its atoms are computed again
+            at the next cutoff.
+            If cache is True, or None and VP_CACHE=1, the VPs of each cutoff are read from /
+            saved to the on-disk vp_cache. """
+        self.model._detach()
+        atoms = self.model.atoms
+        store = vp_cache.get_cache(cache)
+        stale = set() # Atoms whose VP doesn't match their neighbors at the previous cutoff
+        for k,cutoff in enumerate(self.cutoffs):
+            nl = self.neighbors(k)
+            changed = np.array(sorted(stale.union(self.changed(k).tolist())), dtype=int)
+            for a in changed.tolist():
+                atom = atoms[a]
+                atom.neighs = [atoms[x] for x in nl[a].tolist()]
+                atom.cn = len(atom.neighs)
+            if store is not None:
+                key = store.key(self.model, cutoff, (tol, atol, tltol), 'cutoff_sweep', (nl.offsets, nl.indices))
+                if store.load(key, self.model):
+                    stale.clear()
+                    self.model._keep_neighbor_list(nl)
+                    yield cutoff, changed
+                    continue
+            try:
+                for a in changed.tolist():
+                    atom = atoms[a]
+                    if atom.neighs:
+                        # The candidates are exactly atom.neighs, so don't filter them again
+                        voronoi_3d.calculate_atom(self.model, atom, float('inf'), atol=atol, tol=tol, tltol=tltol)
+                    else:
+                        voronoi_3d.save_vp_atom_data(self.model, atom, [], 0, [], 0.0)
+            except Exception as inst:
+                print("Skipping cutoff {0}: the VP of atom {1} failed: {2!r}".format(cutoff, atom.id, inst))
+                stale.update(changed.tolist())
+                continue
+            stale.clear()
+            if store is not None:
+                store.save(key, self.model)
+            self.model._keep_neighbor_list(nl)
+            yield cutoff, changed
@@ -14,10 +14,9 @@ def rot_normal_model(model,arr):
     if(arr.shape == (9,)): arr = arr.reshape((3,3))
     arr = np.linalg.inv(arr)
 
-    for i in range(0,model.natoms):
-        old_coord = [model.atoms[i].coord[0], model.atoms[i].coord[1], model.atoms[i].coord[2]]
-        new_coord = np.dot(np.asarray(old_coord), arr)
-        model.atoms[i].coord = (new_coord[0], new_coord[1], 0.0)
+    positions = model.positions.dot(arr)
+    positions[:,2] = 0.0
+    model.set_positions(positions)
 
 
 def rot(model,arr):
@@ -26,12 +25,12 @@ def rot(model,arr):
     if(arr.shape == (9,)): arr = arr.reshape((3,3))
     arr = np.linalg.inv(arr)
 
-    for i in range(0,model.natoms):
-        old_coord = [model.atoms[i][0], model.atoms[i][1], model.atoms[i][2]]
-        new_coord = np.dot(np.asarray(old_coord), arr)
-        model.atoms[i][0] = new_coord[0]
-        model.atoms[i][1] = new_coord[1]
-        model.atoms[i][2] = 0.0#new_coord[2]
+    # fastModel atoms are [x, y, z, ...] lists
+    new_coords = np.array([atom[:3] for atom in model.atoms], dtype=float).reshape((-1,3)).dot(arr)
+    for atom,(x,y,_) in zip(model.atoms, new_coords.tolist()):
+        atom[0] = x
+        atom[1] = y
+        atom[2] = 0.0#new_coord[2]
 
 
 def calc_rot_array(t1,t2,t3):
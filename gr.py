@@ -6,7 +6,7 @@ from model import Model
 import znum2sym
 
 def gr(m, nbins=0, types=None):
-    if(m.lx != m.ly != m.lz): raise Exception("Can only do cubic boxes currently.")
+    if(m.xsize != m.ysize != m.zsize): raise Exception("Can only do cubic boxes currently.")
     if(types == None):
         types = list(m.atomtypes) # These are ints (atomic numbers)
 
@@ -14,24 +14,22 @@ def gr(m, nbins=0, types=None):
     for x in types:
         count += m.atomtypes[x]
 
-    rho = m.natoms/(m.lx*m.ly*m.lz)
+    rho = m.natoms/(m.xsize*m.ysize*m.zsize)
     if(nbins == 0):
-        nbins = int(m.lx/rho)
-    delg = m.lx*math.sqrt(3)/2.0/(nbins)
+        nbins = int(m.xsize/rho)
+    delg = m.xsize*math.sqrt(3)/2.0/(nbins)
     #delg = 20.0/(nbins)
 
     g = np.zeros(nbins)
-    for i in xrange(0,m.natoms):
-        if(m.atoms[i].z in types):
-            for j in xrange(i+1,m.natoms):
-                if(m.atoms[j].z in types):
-                    r = m.dist(m.atoms[i],m.atoms[j])
-                    if(r < 20.0):
-                        ig = int(r/delg)
-                        g[ig] += 2 # contribution for particles i and j
+    atoms = np.flatnonzero(np.isin(m.znums, types))
+    for rows, _, r in m.dist_many_to_many(atoms, atoms):
+        # Only count each pair (i<j) once
+        r = r[(atoms[None,:] > rows[:,None]) & (r < 20.0)]
+        ig = (r/delg).astype(int)
+        g += 2*np.bincount(ig, minlength=nbins)[:nbins] # contribution for particles i and j
 
     # Normalize gr
-    for i in xrange(0,nbins):
+    for i in range(0,nbins):
         r = delg*(i+0.5)
         vb = ((i+1)**3-i**3)*(delg**3)
         nid = (4.0/3.0)*np.pi*vb*rho
@@ -1,7 +1,10 @@
 from math import ceil,floor,sqrt
 import sys
+import itertools
+import numpy as np
 import znum2sym
 from atom import Atom
+from cutoff import cutoff_matrix
 from collections import defaultdict
 
 def intify(func):
@@ -13,26 +16,58 @@ def intify(func):
 ceil = intify(ceil)
 floor = intify(floor)
 
+# The 27 cells (including itself) that neighbor a cell
+_STENCIL = np.array(list(itertools.product((-1,0,1), repeat=3)), dtype=int)
+
+
+def _cutoff_table(cutoff, znums):
+    """ Returns (species, table, rmax) where species[i] indexes atom i's element in the
+        small table and table[a,b] is the cutoff between a neighbor of species a and a
+        center of species b. cutoff can be a float or a dictionary keyed by (z1,z2). """
+    types, species = np.unique(znums, return_inverse=True)
+    table = cutoff_matrix(cutoff)[np.ix_(types,types)]
+    rmax = table.max() if table.size else float(cutoff)
+    return species, table, rmax
+
+
 class Hutch(object):
-    """ Implements a hutch for a 3D atom model """
+    """ Implements a hutch for a 3D atom model.
+        The box can be cubic, orthorhombic or triclinic (model.cell, e.g. lammps.prism.A).
+        Atoms are binned by their fractional coordinates, so a hutch is a small copy of
+        the simulation cell. If a cutoff is given the hutches are sized so that they are
+        at least that wide; otherwise there is about one atom per hutch. Queries with a
+        larger radius just visit more hutches, they never rebuild the grid (see resize).
+        Every atom's hutch and position in that hutch are tracked by atom id, so atoms
+        can be removed or moved to another hutch in O(1). Atoms whose id is not unique
+        are found by searching their hutch instead. """
 
-    def __init__(self, model=None, check=False):
+    def __init__(self, model=None, check=False, cutoff=None):
         if model is None:
             raise Exception("No input model was given to Hutch().")
-        if(model.xsize != model.ysize != model.zsize):
-            raise Exception("The model must be a cube!")
         self.model = model # Keep a pointer to the parent model
-        self.nhutchs = max(int(round(model.natoms**(1.0/3.0))),1)
-        self.hutchsize = self.model.xsize/self.nhutchs
-        # Create hutch dictionary
-        self.hutchs = {}
-        for i in range(0,self.nhutchs):
-            for j in range(0,self.nhutchs):
-                for k in range(0,self.nhutchs):
-                    self.add_hutch((i,j,k))
-        # Put atoms into their correct hutch
-        for atom in model.atoms:
-            self.add_atom(atom)
+        self.cutoff = cutoff
+        if cutoff is None:
+            # About one atom per hutch until we know what radius will be queried
+            self.nhutchs = self._grid_shape(0.0)
+        else:
+            self.nhutchs = self._grid_shape(cutoff)
+        self.hutchsize = tuple(w/n for w,n in zip(self.widths, self.nhutchs))
+        self._inv_cell = np.linalg.inv(self.cell).tolist()
+        # Create hutch dictionary and put atoms into their correct hutch.
+        # The atoms are sorted by hutch so every hutch is a slice of one sorted list.
+        keys = list(itertools.product(*[range(n) for n in self.nhutchs]))
+        n = np.array(self.nhutchs)
+        cells = np.floor(model.fractional(model.positions)*n).astype(int) % n
+        linear = np.ravel_multi_index(cells.T, self.nhutchs) if len(cells) else np.zeros(0, dtype=int)
+        order = np.argsort(linear, kind='mergesort')
+        linear = linear[order]
+        bounds = np.searchsorted(linear, np.arange(len(keys)+1)).tolist()
+        atoms = model.atoms[:]
+        atoms = [atoms[i] for i in order.tolist()]
+        self.hutchs = dict(zip(keys, [atoms[a:b] for a,b in zip(bounds[:-1], bounds[1:])]))
+        # atom.id -> (hutch, position in self.hutchs[hutch])
+        positions = (np.arange(len(atoms)) - np.array(bounds)[linear]).tolist() if atoms else []
+        self._where = dict(zip(model.ids[order].tolist(), zip([keys[h] for h in linear.tolist()], positions)))
         if check:
             self.check_hutches(model)
 
@@ -46,6 +81,31 @@ class Hutch(object):
     def zsize(self):
         return self.model.zsize
 
+    @property
+    def cell(self):
+        return self.model.cell_matrix
+
+    @property
+    def volume(self):
+        return abs(np.linalg.det(self.cell))
+
+    @property
+    def widths(self):
+        """ The perpendicular distances between opposite faces of the cell. """
+        a, b, c = self.cell
+        v = self.volume
+        return tuple(v/np.linalg.norm(np.cross(u,w)) for u,w in ((b,c),(c,a),(a,b)))
+
+    def _grid_shape(self, cutoff):
+        """ The number of hutches along each cell vector so that every hutch is at least 'cutoff' wide.
+            Hutches are never made smaller than the average atomic spacing. """
+        spacing = (self.volume/max(self.model.natoms,1))**(1.0/3.0)
+        return tuple(max(int(w/max(cutoff,spacing)),1) for w in self.widths)
+
+    def resize(self, cutoff):
+        """ Rebuilds the hutches so that they are sized for 'cutoff'. """
+        self.__init__(self.model, cutoff=cutoff)
+
     def check_hutches(self,model):
         for atom in model.atoms:
             hutch = self._get_hutch(atom)
@@ -59,13 +119,15 @@ class Hutch(object):
 
     def _get_hutch(self,atom):
         """ Returns the hutch that the atom should be located in using a tuple """
-        #x = int(round( (atom.coord[0] + 0.5*self.xsize) / self.hutchsize)) % self.nhutchs
-        #y = int(round( (atom.coord[1] + 0.5*self.ysize) / self.hutchsize)) % self.nhutchs
-        #z = int(round( (atom.coord[2] + 0.5*self.zsize) / self.hutchsize)) % self.nhutchs
-        x = int(floor( (atom.coord[0] + 0.5*self.xsize) / self.hutchsize)) % self.nhutchs
-        y = int(floor( (atom.coord[1] + 0.5*self.ysize) / self.hutchsize)) % self.nhutchs
-        z = int(floor( (atom.coord[2] + 0.5*self.zsize) / self.hutchsize)) % self.nhutchs
-        return (x,y,z)
+        x,y,z = atom.coord
+        inv = self._inv_cell
+        return tuple(int(floor((x*inv[0][d] + y*inv[1][d] + z*inv[2][d] + 0.5)*n)) % n for d,n in enumerate(self.nhutchs))
+
+    def _get_hutches(self, positions):
+        """ Returns the hutch of every row of 'positions' as a list of tuples """
+        n = np.array(self.nhutchs)
+        cells = np.floor(self.model.fractional(positions)*n).astype(int) % n
+        return [tuple(cell) for cell in cells.tolist()]
 
     def add_atom(self,atom):
         hutch = self._get_hutch(atom)
@@ -73,14 +135,105 @@ class Hutch(object):
             raise Exception("You gave an improper hutch address! {0}".format(hutch))
         #if atom in self.hutchs[hutch]:
         #    raise Exception("Atom already exists in that hutch: {0}".format(atom))
+        self._append(hutch, atom)
+
+    def add_atoms(self, atoms):
+        """ Adds many atoms at once, binning them in a single vectorized pass. """
+        atoms = list(atoms)
+        if not atoms:
+            return
+        positions = np.array([atom.coord for atom in atoms], dtype=float)
+        for atom,hutch in zip(atoms, self._get_hutches(positions)):
+            self._append(hutch, atom)
+
+    def _append(self, hutch, atom):
+        self._where[atom.id] = (hutch, len(self.hutchs[hutch]))
         self.hutchs[hutch].append(atom)
 
+    def _pop(self, hutch, i):
+        """ Removes the i'th atom of a hutch by moving the hutch's last atom into its place. """
+        atoms = self.hutchs[hutch]
+        last = atoms.pop()
+        if i < len(atoms):
+            atoms[i] = last
+            self._where[last.id] = (hutch, i)
+
+    def _locate(self, atom):
+        """ Returns (hutch, position) of atom, or None if it isn't where we expect it to be. """
+        try:
+            hutch, i = self._where[atom.id]
+            found = self.hutchs[hutch][i]
+        except (KeyError, IndexError):
+            return None
+        if found is atom or found == atom:
+            return hutch, i
+        return None
+
     def remove_atom(self,atom):
+        location = self._locate(atom)
+        if location is not None:
+            del self._where[atom.id]
+            self._pop(*location)
+            return
         hutch = self._get_hutch(atom)
         try:
             self.hutchs[hutch].remove(atom)
-        except IndexError:
+        except ValueError:
             raise Exception("Trying to remove an atom that doesn't exist in the hutch found!")
+        self._reindex(hutch)
+
+    def _reindex(self, hutch):
+        for i,atom in enumerate(self.hutchs[hutch]):
+            self._where[atom.id] = (hutch, i)
+
+    def move_atom(self, atom, coord):
+        """ Sets atom.coord = coord and moves the atom to its new hutch if it changed. """
+        location = self._locate(atom)
+        if location is None:
+            # Untracked atom, fall back to a search through its current hutch
+            self.remove_atom(atom)
+            atom.coord = tuple(coord)
+            self.add_atom(atom)
+            return
+        atom.coord = tuple(coord)
+        hutch = self._get_hutch(atom)
+        if hutch != location[0]:
+            self._pop(*location)
+            self._append(hutch, atom)
+
+    def update(self):
+        """ Moves the atoms whose coordinates changed hutch (e.g. after a translation)
+            without rebuilding the other hutches. Returns the number of atoms moved.
+            The atoms stored in the hutches are checked directly, so ids don't need to be
+            unique. If the model has a different number of atoms the hutch is rebuilt. """
+        keys = list(self.hutchs)
+        counts = [len(self.hutchs[hutch]) for hutch in keys]
+        if sum(counts) != self.model.natoms:
+            self.__init__(self.model, cutoff=self.cutoff)
+            return self.model.natoms
+        if not keys or not sum(counts):
+            return 0
+        atoms = list(itertools.chain.from_iterable(self.hutchs[hutch] for hutch in keys))
+        old = np.repeat(np.array(keys, dtype=int), counts, axis=0)
+        n = np.array(self.nhutchs)
+        cells = np.floor(self.model.fractional(np.array([atom.coord for atom in atoms], dtype=float))*n).astype(int) % n
+        rows = np.flatnonzero((cells != old).any(axis=1)).tolist()
+        if 4*len(rows) > len(atoms):
+            # Binning everything again is faster than moving most of the atoms
+            self.__init__(self.model, cutoff=self.cutoff)
+            return len(rows)
+        moved = [(tuple(old[r].tolist()), atoms[r], tuple(cells[r].tolist())) for r in rows]
+        leaving = set(id(atom) for _,atom,_ in moved)
+        changed = set()
+        for hutch in set(hutch for hutch,_,_ in moved):
+            self.hutchs[hutch] = [atom for atom in self.hutchs[hutch] if id(atom) not in leaving]
+            changed.add(hutch)
+        for _,atom,cell in moved:
+            self.hutchs[cell].append(atom)
+            changed.add(cell)
+        for hutch in changed:
+            self._reindex(hutch)
+        return len(moved)
 
     def get_atoms_in_same_hutch(self,atom):
         hutch = self._get_hutch(atom)
@@ -88,30 +241,72 @@ class Hutch(object):
 
     def get_atoms_in_radius(self,theatom,cutoff):
         if(isinstance(cutoff,dict)):
-            r2 = {key:r*r for key,r in cutoff.iteritems()}
-            radius = max(r for _,r in cutoff.iteritems())
+            r2 = {key:r*r for key,r in cutoff.items()}
+            radius = max(r for _,r in cutoff.items())
         else:
             radius = cutoff
             r2 = defaultdict(lambda: radius**2)
             cutoff = defaultdict(lambda: cutoff)
-        x,y,z = theatom.coord
-        hx = (x + self.xsize*0.5) /self.hutchsize
-        hy = (y + self.ysize*0.5) /self.hutchsize
-        hz = (z + self.zsize*0.5) /self.hutchsize
-        hr = radius/self.hutchsize
-        lhx = floor(hx-hr)
-        lhy = floor(hy-hr)
-        lhz = floor(hz-hr)
-        uhx = ceil(hx+hr)
-        uhy = ceil(hy+hr)
-        uhz = ceil(hz+hr)
-        hutches  = [(i,j,k,) for i in range(lhx,uhx) for j in range(lhy,uhy) for k in range(lhz,uhz)]
-        hutches = [tuple([q if 0<=q<self.nhutchs else q%self.nhutchs for q in h]) for h in hutches] #pbc
+        f = self.model.fractional(theatom.coord)
+        ranges = []
+        for x,n,w in zip(f, self.nhutchs, self.widths):
+            h = x*n
+            hr = radius/w*n
+            ranges.append(range(floor(h-hr), ceil(h+hr)))
+        hutches = set((i%self.nhutchs[0], j%self.nhutchs[1], k%self.nhutchs[2]) for i in ranges[0] for j in ranges[1] for k in ranges[2]) #pbc
         atoms = [ atom for hutch in hutches for atom in self.hutchs[hutch]
             if(self.model.dist2(atom,theatom) < r2[(atom.z,theatom.z)]) ]
         if(theatom in atoms): atoms.remove(theatom)
         return atoms
 
+    def get_all_neighbors(self, cutoff, vectors=False, chunksize=20000):
+        """ Finds every neighbor pair in the model in one pass.
+            Positions are binned into cells at least as wide as the largest cutoff and each
+            atom is compared with the atoms in the 27 surrounding cells (periodic) using the
+            minimum image convention. cutoff can be a float or a dictionary keyed by (z1,z2).
+            Returns (i, j, dist) arrays sorted by i then j, where atom j is a neighbor of atom i.
+            If vectors is True the (npairs,3) displacements from i to j are returned as a fourth array. """
+        pos = self.model.positions
+        natoms = len(pos)
+        species, table, rmax = _cutoff_table(cutoff, self.model.znums)
+        cut2 = table**2
+
+        ncells = np.array(self._grid_shape(rmax))
+        cells = np.floor(self.model.fractional(pos)*ncells).astype(int) % ncells
+        cellids = np.ravel_multi_index(cells.T, ncells)
+        order = np.argsort(cellids, kind='stable')
+        counts = np.bincount(cellids, minlength=np.prod(ncells))
+        starts = np.cumsum(counts) - counts
+        # Small boxes (fewer than 3 cells along a side) would visit the same cell twice
+        offsets = np.array(sorted(set(tuple(off % ncells) for off in _STENCIL)), dtype=int)
+
+        ii, jj, dd, vv = [], [], [], []
+        for lo in range(0, natoms, chunksize):
+            centers = np.arange(lo, min(lo+chunksize, natoms))
+            for off in offsets:
+                nbr = np.ravel_multi_index(((cells[centers] + off) % ncells).T, ncells)
+                n = counts[nbr]
+                i = np.repeat(centers, n)
+                first = np.repeat(starts[nbr] - (np.cumsum(n) - n), n)
+                j = order[first + np.arange(len(i))]
+                d = self.model.minimum_image(pos[j] - pos[i])
+                r2 = np.einsum('ij,ij->i', d, d)
+                keep = (r2 < cut2[species[j], species[i]]) & (i != j)
+                ii.append(i[keep])
+                jj.append(j[keep])
+                dd.append(np.sqrt(r2[keep]))
+                if vectors:
+                    vv.append(d[keep])
+        if not ii:
+            ii, jj, dd, vv = [np.zeros(0, dtype=int)], [np.zeros(0, dtype=int)], [np.zeros(0)], [np.zeros((0,3))]
+        i = np.concatenate(ii)
+        j = np.concatenate(jj)
+        d = np.concatenate(dd)
+        srt = np.lexsort((j, i))
+        if vectors:
+            return i[srt], j[srt], d[srt], np.concatenate(vv)[srt]
+        return i[srt], j[srt], d[srt]
+
 def main():
     model = Model(sys.argv[1])
     #hutch = Hutch(model)
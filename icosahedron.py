@@ -132,7 +132,7 @@ def perturb_atom(m,i=None,amount=None,axis=None):
         amount = random.uniform(-mindist/frac,mindist/frac)
     c = list(m.atoms[i].coord)
     c[axis] = c[axis] + amount
-    m.atoms[i].coord = tuple(c)
+    m.move_atom(m.atoms[i], c)
     #print("Perturbed atom {0} by {1} in direction {2}".format(i,amount,axis))
     return("Perturbed atom {0} by {1} in direction {2}".format(i,amount,axis))
 
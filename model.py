@@ -2,18 +2,26 @@
 #matplotlib.use('PDF')
 import sys, os
 import copy
+import contextlib
+import gzip
+import hashlib
+import itertools
 #import matplotlib.pyplot as plt
 import numpy as np
-from scipy.spatial import Voronoi, voronoi_plot_2d
+from scipy.spatial import Voronoi, voronoi_plot_2d, cKDTree
 from pprint import pprint
 from atom import Atom
-from hutch import Hutch
+from atom_arrays import AtomArrays
+from hutch import Hutch, _STENCIL
+from neighbor_list import NeighborList
+from spatial_hash import SpatialHash
+from cutoff import cutoff_matrix
 import znum2sym
 import math
 from collections import defaultdict, Counter
-from tools import drange
 
 import voronoi_3d
+import bond_angle_distribution
 import rotate_3d
 
 
@@ -24,21 +32,244 @@ class Masses(object):
     def __init__(self):
         self.masses = {1:1.007947, 2:4.0026022, 3:6.9412, 4:9.0121823, 5:10.8117, 6:12.01078, 7:14.00672, 8:15.99943, 9:18.99840325, 10:20.17976, 11:22.989769282, 12:24.30506, 13:26.98153868, 14:28.08553, 15:30.9737622, 16:32.0655, 17:35.4532, 18:39.9481, 19:39.09831, 20:40.0784, 21:44.9559126, 22:47.8671, 23:50.94151, 24:51.99616, 25:54.9380455, 26:55.8452, 27:58.9331955, 28:58.69342, 29:63.5463, 30:65.4094, 31:69.7231, 32:72.641, 33:74.921602, 34:78.963, 35:79.9041, 36:83.7982, 37:85.46783, 38:87.621, 39:88.905852, 40:91.2242, 41:92.906382, 42:95.942, 43:98, 44:101.072, 45:102.905502, 46:106.421, 47:107.86822, 48:112.4118, 49:114.8183, 50:118.7107, 51:121.7601, 52:127.603, 53:126.904473, 54:131.2936, 55:132.90545192, 56:137.3277, 57:138.905477, 58:140.1161, 59:140.907652, 60:144.2423, 61:145, 62:150.362, 63:151.9641, 64:157.253, 65:158.925352, 66:162.5001, 67:164.930322, 68:167.2593, 69:168.934212, 70:173.043, 71:174.9671, 72:178.492, 73:180.947882, 74:183.841, 75:186.2071, 76:190.233, 77:192.2173, 78:195.0849, 79:196.9665694, 80:200.592, 81:204.38332, 82:207.21, 83:208.980401, 84:210, 85:210, 86:220, 87:223, 88:226, 89:227, 91:231.035882, 90:232.038062, 93:237, 92:238.028913, 95:243, 94:244, 96:247, 97:247, 98:251, 99:252, 100:257, 101:258, 102:259, 103:262, 104:261, 105:262, 106:266, 107:264, 108:277, 109:268, 110:271, 111:272, 112:285, 113:284, 114:289, 115:288, 116:292, 118:293}
 
+        # Rounded-mass index for get_znum. A mass given with p decimals matches an element
+        # whose tabulated mass has p2 decimals if both agree when rounded to min(p, p2).
+        # _at_least[(p, round(m,p))] covers the elements with p2 >= p, and
+        # _exactly[(p2, round(m,p2))] the ones with fewer decimals than the query.
+        self._order = dict((z,i) for i,z in enumerate(self.masses))
+        self._at_least = defaultdict(list)
+        self._exactly = defaultdict(list)
+        for z, m in self.masses.items():
+            prec2 = self._precision(m)
+            for p in range(prec2+1):
+                self._at_least[(p, round(m, p))].append(z)
+            self._exactly[(prec2, round(m, prec2))].append(z)
+        self._znums = {}
+
+    @staticmethod
+    def _precision(mass):
+        """ Number of decimals 'mass' was written with. """
+        return len(str(mass)[int(math.log10(mass))+2:])
+
     def get_mass(self, znum):
         return self.masses[znum]
 
     def get_znum(self, mass):
-        prec1 = len(str(mass)[int(math.log10(mass))+2:])
-        for z, m in self.masses.items():
-            prec2 = len(str(m)[int(math.log10(m))+2:])
-            p = min(prec1, prec2)
-            if round(mass, p) == round(m, p): return z
-        raise Exception("Mass not found!")
+        try:
+            return self._znums[mass]
+        except KeyError:
+            pass
+        prec1 = self._precision(mass)
+        candidates = list(self._at_least.get((prec1, round(mass, prec1)), []))
+        for p in range(prec1):
+            candidates.extend(self._exactly.get((p, round(mass, p)), []))
+        if not candidates:
+            raise Exception("Mass not found!")
+        z = min(candidates, key=self._order.get)
+        self._znums[mass] = z
+        return z
 
 
 masses = Masses()
 
 
+def _read_xyz(filename):
+    """ Reads an xyz model file. The atom block is parsed in one pass into arrays.
+        Returns (comment, (xsize,ysize,zsize), znums, positions). """
+    with open(filename) as f:
+        natoms = int(f.readline().strip())
+        comment = f.readline().strip()
+        words = ''.join(itertools.islice(f, natoms)).split()
+    if len(words) != 4*natoms:
+        raise Exception("Expected {0} lines with 4 columns each in the xyz file {1}.".format(natoms, filename))
+    try:
+        box = tuple([float(x) for x in comment.split()[:3]])
+        if len(box) != 3:
+            raise ValueError
+    except ValueError:
+        box = (None,None,None)
+    symbols, inverse = np.unique(words[0::4], return_inverse=True)
+    symbols = [int(sym) if sym.isdigit() else znum2sym.sym2z(sym) for sym in symbols.tolist()]
+    znums = np.array(symbols, dtype=int)[inverse]
+    positions = np.array([words[1::4], words[2::4], words[3::4]], dtype=float).T
+    return comment, box, znums, np.ascontiguousarray(positions)
+
+
+def _read_xyz_cached(filename):
+    """ Same as _read_xyz, but the parsed arrays are stored in <filename>.npz together with
+        the sha1 of the xyz file. The sidecar is used instead of parsing while the hash matches. """
+    with open(filename, 'rb') as f:
+        sha1 = hashlib.sha1(f.read()).hexdigest()
+    sidecar = filename + '.npz'
+    if os.path.exists(sidecar):
+        try:
+            data = np.load(sidecar)
+            if str(data['sha1']) == sha1:
+                box = tuple(None if np.isnan(x) else float(x) for x in data['box'])
+                return str(data['comment']), box, data['znums'], data['positions']
+        except (IOError, KeyError, ValueError):
+            pass
+    comment, box, znums, positions = _read_xyz(filename)
+    try:
+        with open(sidecar, 'wb') as f:
+            np.savez(f, sha1=sha1, comment=comment, znums=znums, positions=positions,
+                     box=np.array([np.nan if x is None else x for x in box], dtype=float))
+    except IOError:
+        pass # e.g. read-only directory; the cache is optional
+    return comment, box, znums, positions
+
+
+def _read_dat(filename, chunksize=100000):
+    """ Reads a LAMMPS data file (atom_style atomic) in a single streaming pass.
+        Sections are located by their header line; the Atoms section is parsed in
+        chunks of 'chunksize' lines so only one chunk of text is held at a time.
+        Returns (comment, (xsize,ysize,zsize), tilt, ids, znums, positions) where
+        tilt is (xy,xz,yz) or None. """
+    natoms = None
+    box = [None,None,None]
+    tilt = None
+    types = {}
+    ids = typs = positions = None
+    with open(filename) as f:
+        comment = f.readline()
+        line = f.readline()
+        while line:
+            words = line.split('#')[0].split()
+            if not words:
+                line = f.readline()
+                continue
+            if words[0] == 'Masses':
+                for line in _section_lines(f):
+                    words = line.split()
+                    types[int(words[0])] = masses.get_znum(float(words[1]))
+                line = f.readline()
+            elif words[0] == 'Atoms':
+                if natoms is None:
+                    raise Exception("ERROR! The number of atoms must be given before the Atoms section.")
+                ids, typs, positions = _read_dat_atoms(f, natoms, chunksize)
+                line = f.readline()
+            elif words[0][0].isalpha():
+                # Some other section (Velocities, ...)
+                for line in _section_lines(f):
+                    pass
+                line = f.readline()
+            else:
+                if line.startswith('#'):
+                    pass
+                elif 'atoms' in line:
+                    natoms = int(words[0])
+                elif 'xlo' in line and 'xhi' in line:
+                    box[0] = abs(float(words[0])) + abs(float(words[1]))
+                elif 'ylo' in line and 'yhi' in line:
+                    box[1] = abs(float(words[0])) + abs(float(words[1]))
+                elif 'zlo' in line and 'zhi' in line:
+                    box[2] = abs(float(words[0])) + abs(float(words[1]))
+                elif 'xy' in line and 'xz' in line and 'yz' in line:
+                    tilt = tuple(float(x) for x in words[:3])
+                line = f.readline()
+    if not types:
+        raise Exception("ERROR! You need to define the masses in the .dat file.")
+    if positions is None:
+        raise Exception("ERROR! No Atoms section found in {0}.".format(filename))
+    table = np.zeros(max(types)+1, dtype=int)
+    for t,z in types.items():
+        table[t] = z
+    return comment, tuple(box), tilt, ids, table[typs], positions
+
+
+def _section_lines(f):
+    """ Yields the non-blank, non-comment lines of the section body that follows a header
+        line in 'f'. Leading blank lines are skipped; the body ends at the next blank line. """
+    started = False
+    for line in iter(f.readline, ''):
+        if line.startswith('#'):
+            continue
+        if not line.strip():
+            if started:
+                return
+            continue
+        started = True
+        yield line
+
+
+def _read_dat_atoms(f, natoms, chunksize):
+    """ Parses the next 'natoms' atom lines of 'f' (id type x y z ...) into arrays. """
+    ids = np.empty(natoms, dtype=int)
+    typs = np.empty(natoms, dtype=int)
+    positions = np.empty((natoms,3), dtype=float)
+    lines = _section_lines(f)
+    start = 0
+    while start < natoms:
+        chunk = list(itertools.islice(lines, min(chunksize, natoms-start)))
+        if not chunk:
+            raise Exception("Expected {0} atoms but found only {1}.".format(natoms, start))
+        text = ''.join(chunk)
+        words = text.split()
+        ncol = len(words) // len(chunk)
+        if '#' not in text and ncol >= 5 and ncol*len(chunk) == len(words):
+            cols = np.array(words, dtype=float).reshape((len(chunk),ncol))[:,:5]
+        else:
+            # Uneven columns or trailing comments
+            cols = np.array([line.split('#')[0].split()[:5] for line in chunk], dtype=float)
+        stop = start + len(chunk)
+        ids[start:stop] = cols[:,0]
+        typs[start:stop] = cols[:,1]
+        positions[start:stop] = cols[:,2:5]
+        start = stop
+    return ids, typs, positions
+
+
+@contextlib.contextmanager
+def _open_output(outfile):
+    """ Opens 'outfile' for writing text (gzip-compressed if it ends in .gz) and closes it
+        on exit. If outfile is None, sys.stdout is used and left open. """
+    if outfile is None:
+        yield sys.stdout
+        return
+    if outfile.endswith('.gz'):
+        of = gzip.open(outfile, 'wt', compresslevel=6)
+    else:
+        of = open(outfile, 'w')
+    try:
+        yield of
+    finally:
+        of.close()
+
+
+def _format_columns(columns, fmt=None, sep='\t', chunksize=10000):
+    """ Formats whole columns and yields them as blocks of at most 'chunksize' lines, using
+        a single %-format over each block, so that writers can pass every block to f.write
+        without building the whole file in memory. Each column is either a list of strings
+        or a numeric array. Float columns are written with str, or with the %-format 'fmt' if given. """
+    n = len(columns[0])
+    formats = []
+    for col in columns:
+        if isinstance(col, np.ndarray):
+            formats.append(fmt if fmt is not None and col.dtype.kind == 'f' else '%s')
+        else:
+            formats.append('%s')
+    template = sep.join(formats) + '\n'
+    for lo in range(0, n, chunksize):
+        values = [col[lo:lo+chunksize] for col in columns]
+        values = [col.tolist() if isinstance(col, np.ndarray) else col for col in values]
+        yield (template*len(values[0])) % tuple(itertools.chain.from_iterable(zip(*values)))
+
+
+def _write_igor(outfile, waves):
+    """ Writes 'waves', a list of (name, array, setscale command), to an IGOR text file.
+        The last axis of each array is written as one line. """
+    with open(outfile, 'w') as of:
+        of.write('IGOR\n')
+        for name, wave, setscale in waves:
+            wave = np.asarray(wave)
+            of.write('\nWAVES/N=({0})\t {1}\nBEGIN\n'.format(','.join(str(x) for x in wave.shape), name))
+            rows = wave.reshape((-1, wave.shape[-1]))
+            for block in _format_columns(list(rows.T.astype(float)), sep=' '):
+                of.write(block.replace('\n', ' \n'))
+            of.write('END\n')
+            of.write(setscale+'\n')
+
+
 class Model(object):
     """
         Holds an atomic model and defines a set of helper functions for it.
@@ -47,9 +278,15 @@ class Model(object):
             generate_neighbors(cutoff):  Generates neighbors for every atom using the supplied cutoff (which can be a float or a dictionary)
             get_atoms_in_cutoff(atom,cutoff)
             nearest_neigh(atom)
+        The box is orthorhombic (xsize, ysize, zsize) unless cell is given: a 3x3 array whose rows are
+        the box vectors (e.g. lammps.prism.A). Atoms are centered on the origin in either case.
+        If arrays=True the atoms are stored in contiguous numpy arrays (see atom_arrays.AtomArrays)
+        and self.atoms[i] returns a lightweight view into those arrays.
+        If cache=True an xyz file is parsed once and saved next to it as <modelfile>.npz;
+        later loads reuse that file as long as the content hash of the xyz file matches.
     """
     
-    def __init__(self, modelfilename=None, comment=None, xsize=None, ysize=None, zsize=None, atoms=None):
+    def __init__(self, modelfilename=None, comment=None, xsize=None, ysize=None, zsize=None, atoms=None, arrays=False, cell=None, cache=False):
         """ sets:
                 self.comment
                 self.xsize
@@ -64,15 +301,22 @@ class Model(object):
                 self.coord_numbers """
 
         self.filename = modelfilename
+        self.cell = None
         if self.filename is not None:
-            self._load()
+            self._load(arrays, cache)
         else:
             self.comment = comment
+            if cell is not None:
+                self.cell = np.array(cell, dtype=float)
+                if xsize is None and ysize is None and zsize is None:
+                    xsize, ysize, zsize = np.diag(self.cell).tolist()
             self.xsize = xsize
             self.ysize = ysize
             self.zsize = zsize
             self.atoms = [atom.copy() for atom in atoms]
             self.natoms = len(self.atoms)
+        if arrays and not self.array_backed:
+            self.atoms = AtomArrays.from_atoms(self.atoms)
 
         if(self.xsize and self.ysize and self.zsize):
             self.hutch = Hutch(self)
@@ -81,178 +325,279 @@ class Model(object):
             self.atomtypes = Counter(atom.z for atom in self.atoms)
 
     def __contains__(self, key):
-        return key in self.atoms
+        try:
+            self._slot_of(key)
+        except ValueError:
+            return False
+        return True
 
     def __getitem__(self, atomid):
-        try:
-            if(self.atoms[atomid].id == atomid):
-                return self.atoms[atomid]
-            else:
-                raise Exception("Atom positions have been shuffled or you gave an out of bounds index.")
-        except:
-            for atom in self.atoms:
-                if(atom.id == atomid):
-                    return atom
-        return None
+        """ Returns the atom with id 'atomid', or None if there is no such atom. """
+        slot = self._slot_of_id(atomid)
+        if slot is None:
+            return None
+        return self.atoms[slot]
 
     def __len__(self):
         assert self.natoms == len(self.atoms)
         return self.natoms
-        
+
+    def _index_atoms(self):
+        """ Rebuilds the atom.id -> position in self.atoms index. If ids repeat, the first atom wins. """
+        if self.array_backed:
+            ids = self.atoms.ids.tolist()
+        else:
+            ids = [atom.id for atom in self.atoms]
+        n = len(ids)
+        self._slots = dict(zip(reversed(ids), range(n-1,-1,-1)))
+
+    def _slot_of_id(self, atomid):
+        """ Returns the position of the atom with id 'atomid' in self.atoms, or None.
+            self.atoms can be modified directly by scripts, so the index is checked
+            and rebuilt if it turns out to be stale. """
+        slots = self.__dict__.get('_slots')
+        if slots is None:
+            self._index_atoms()
+            slots = self._slots
+        slot = slots.get(atomid)
+        if slot is not None and slot < len(self.atoms) and self.atoms[slot].id == atomid:
+            return slot
+        self._index_atoms()
+        return self._slots.get(atomid)
+
+    def _slot_of(self, atom):
+        """ Returns the position of 'atom' in self.atoms (see Atom.__eq__), looking it up by id first. """
+        slot = self._slot_of_id(atom.id)
+        if slot is not None:
+            found = self.atoms[slot]
+            if found is atom or found == atom:
+                return slot
+        return self.atoms.index(atom)
+
     def add(self, atom, reset_id=False):
         """ Adds atom 'atom' to the model. Note that there is no error checking to prevent
         the user from adding an atom twice. Be careful not to do that. """
         if reset_id:
             atom.id = self.natoms
+        self.__dict__.pop('neighbor_list', None)
+        self.__dict__.pop('_verlet', None)
         self.atoms.append(atom)
         self.natoms += 1
         self.atomtypes[atom.z] += 1
+        if '_slots' in self.__dict__:
+            self._slots.setdefault(atom.id, len(self.atoms)-1)
+        try:
+            self.hutch.add_atom(self.atoms[-1])
+        except AttributeError:
+            pass
+
+    def add_many(self, atoms, reset_id=False):
+        """ Adds all of 'atoms' to the model, updating atomtypes and the hutch once. """
+        atoms = list(atoms)
+        if reset_id:
+            for i,atom in enumerate(atoms):
+                atom.id = self.natoms + i
+        self.__dict__.pop('neighbor_list', None)
+        self.__dict__.pop('_verlet', None)
+        start = len(self.atoms)
+        self.atoms.extend(atoms)
+        self.natoms += len(atoms)
+        self.atomtypes.update(atom.z for atom in atoms)
+        if '_slots' in self.__dict__:
+            for i,atom in enumerate(atoms):
+                self._slots.setdefault(atom.id, start+i)
         try:
-            self.hutch.add_atom(atom)
+            self.hutch.add_atoms(self.atoms[start:])
         except AttributeError:
             pass
 
     def remove(self, atom):
-        """ Removes atom 'atom' from the model """
+        """ Removes atom 'atom' from the model in O(1). The last atom of self.atoms is
+            moved into the removed atom's place, so the order of the atoms changes. """
+        self.__dict__.pop('neighbor_list', None)
+        self.__dict__.pop('_verlet', None)
+        slot = self._slot_of(atom)
+        atom = self.atoms[slot]
+        z, atomid = atom.z, atom.id
         try:
             self.hutch.remove_atom(atom)
         except:# AttributeError or ValueError:
             pass
-        self.atoms.remove(atom)
+        last = len(self.atoms) - 1
+        if self.array_backed:
+            if slot != last and hasattr(self, 'hutch'):
+                # The hutch holds a view of the last slot, which is about to move into 'slot'
+                self.hutch.remove_atom(self.atoms[last])
+            self.atoms.swap_remove(slot)
+            if slot != last:
+                moved = self.atoms[slot]
+                if hasattr(self, 'hutch'):
+                    self.hutch.add_atom(moved)
+        else:
+            moved = self.atoms[last]
+            self.atoms[slot] = moved
+            self.atoms.pop()
+        if self._slots.get(atomid) == slot:
+            del self._slots[atomid]
+        if slot != last:
+            self._slots[moved.id] = slot
         self.natoms -= 1
-        self.atomtypes[atom.z] -= 1
+        self.atomtypes[z] -= 1
 
-    def _load(self):
+    def remove_many(self, atoms):
+        """ Removes all of 'atoms' from the model, updating atomtypes and the hutch once.
+            Unlike remove, the order of the remaining atoms is kept. """
+        self.__dict__.pop('neighbor_list', None)
+        self.__dict__.pop('_verlet', None)
+        slots = set(self._slot_of(atom) for atom in atoms)
+        if not slots:
+            return
+        keep = np.ones(len(self.atoms), dtype=bool)
+        keep[list(slots)] = False
+        removed = Counter(self.znums[~keep].tolist())
+        if self.array_backed:
+            self.atoms.compress(keep)
+        else:
+            if hasattr(self, 'hutch'):
+                for i in slots:
+                    try:
+                        self.hutch.remove_atom(self.atoms[i])
+                    except:# ValueError
+                        pass
+            self.atoms[:] = [atom for atom,k in zip(self.atoms, keep.tolist()) if k]
+        self.natoms -= len(slots)
+        self.atomtypes.subtract(removed)
+        self._index_atoms()
+        if self.array_backed and hasattr(self, 'hutch'):
+            # Every slot after the first removed one moved, so bin the views again
+            self.hutch = Hutch(self, cutoff=self.hutch.cutoff)
+
+    def _load(self, arrays=False, cache=False):
         filename, ext = os.path.splitext(self.filename)
         if(ext == 'xyz' or ext == '.xyz'):
-            self._load_xyz()
+            self._load_xyz(arrays, cache)
         elif(ext == 'dat' or ext == '.dat'):
-            self._load_dat()
+            self._load_dat(arrays)
         else:
             raise Exception("Unknown input model type! File {0} has extension {1}".format(self.filename,ext))
 
-    def _load_xyz(self):
-        modelfile = self.filename
-        self.atoms = []
-        self.atomtypes = defaultdict(int)
-        self.natoms = 0
-        with open(modelfile) as f:
-            natoms = int(f.readline().strip())
-            self.comment = f.readline().strip()
-            try:
-                self.xsize,self.ysize,self.zsize = tuple([float(x) for x in self.comment.split()[:3]])
-            except:
-                self.xsize,self.ysize,self.zsize = (None,None,None)
-            for i in range(natoms):
-                znum,x,y,z = tuple(f.readline().strip().split())
-                x = float(x); y = float(y); z = float(z)
-                atom = Atom(i,znum,x,y,z)
-                self.add(atom)
-
-    def _load_dat(self):
-        """ Still need to refactor """
-        modelfile = self.filename
-        with open(modelfile) as f:
-            content = f.readlines()
-
-        self.comment = content.pop(0) # Comment line
-        content = [x for x in content if not x.startswith('#')]
-
-        for line in content:
-            if('atoms' in line): self.natoms = int(line.split()[0])
-            if('xlo' in line and 'xhi' in line):
-                self.xsize = abs(float(line.split()[0])) + abs(float(line.split()[1]))
-            if('ylo' in line and 'yhi' in line):
-                self.ysize = abs(float(line.split()[0])) + abs(float(line.split()[1]))
-            if('zlo' in line and 'zhi' in line):
-                self.zsize = abs(float(line.split()[0])) + abs(float(line.split()[1]))
-            if('atom types' in line): nelems = int(line.split()[0])
-            if('Masses' in line): mflag = content.index(line) + 1
-            if('Atoms' in line): aflag = content.index(line) + 1
-        try:
-            mflag
-        except NameError:
-            raise Exception("ERROR! You need to define the masses in the .dat file.")
-        atomtypes = {}
-        while(nelems > 0):
-            if(len(content[mflag].split()) == 2):
-                atomtypes[int(content[mflag].split()[0])] = masses.get_znum(float(content[mflag].split()[1]))
-                nelems -= 1
-            mflag += 1
-        self.atoms = []
-        natoms = self.natoms
-        while(natoms > 0):
-            sline = content[aflag].split()
-            if(len(sline) >= 5):
-                # We found an atom
-                id = int(sline[0])
-                type = int(sline[1])
-                x = float(sline[2])
-                y = float(sline[3])
-                z = float(sline[4])
-                znum = atomtypes[type]
-                # Add it to the model
-                self.atoms.append(Atom(id,znum,x,y,z))
-                natoms -= 1
-            aflag += 1
-
-    def write(self, outfile=None, ext=None, reverse=True):
-        if(outfile is not None and ext is None): _,ext = os.path.splitext(outfile)
+    def _load_xyz(self, arrays=False, cache=False):
+        if cache:
+            comment, box, znums, positions = _read_xyz_cached(self.filename)
+        else:
+            comment, box, znums, positions = _read_xyz(self.filename)
+        self.comment = comment
+        self.xsize, self.ysize, self.zsize = box
+        self._set_atoms(znums, positions, arrays)
+
+    @staticmethod
+    def from_arrays(znums, positions, ids=None, comment='', xsize=None, ysize=None, zsize=None, cell=None, arrays=False):
+        """ Creates a model directly from znum and position arrays without going through Atom.copy. """
+        model = Model(comment=comment, atoms=[], cell=cell)
+        if xsize is not None or ysize is not None or zsize is not None:
+            model.xsize, model.ysize, model.zsize = xsize, ysize, zsize
+        model._set_atoms(znums, positions, arrays, ids)
+        if(model.xsize and model.ysize and model.zsize):
+            model.hutch = Hutch(model)
+        return model
+
+    def _set_atoms(self, znums, positions, arrays=False, ids=None):
+        """ Creates the atoms of the model from arrays in one go. """
+        natoms = len(znums)
+        if ids is None:
+            ids = np.arange(natoms)
+        if arrays:
+            self.atoms = AtomArrays(ids, znums, positions)
+        else:
+            self.atoms = [Atom(i,z,x,y,zz) for i,z,(x,y,zz) in zip(np.asarray(ids).tolist(), np.asarray(znums).tolist(), np.asarray(positions).tolist())]
+        self.natoms = natoms
+        self.atomtypes = Counter(dict(zip(*[x.tolist() for x in np.unique(znums, return_counts=True)])))
+
+    def _load_dat(self, arrays=False):
+        comment, box, tilt, ids, znums, positions = _read_dat(self.filename)
+        self.comment = comment
+        self.xsize, self.ysize, self.zsize = box
+        if tilt is not None:
+            xy, xz, yz = tilt
+            self.cell = np.array([[self.xsize,0.,0.],[xy,self.ysize,0.],[xz,yz,self.zsize]])
+        self._set_atoms(znums, positions, arrays, ids=ids)
+
+    def write(self, outfile=None, ext=None, reverse=True, fmt=None):
+        """ Writes the model to 'outfile' (stdout if None). The format is taken from the
+            extension unless 'ext' is given; a trailing .gz (e.g. model.xyz.gz) writes
+            gzip-compressed output. 'fmt' is an optional %-format for the coordinate
+            columns, e.g. '%.6f'; by default floats are written at full precision.
+            Files are closed before this returns. """
+        if(outfile is not None and ext is None):
+            name = outfile[:-3] if outfile.endswith('.gz') else outfile
+            _,ext = os.path.splitext(name)
         elif(ext is None): ext = '.xyz'
         if(ext == '.xyz' or ext == 'xyz'):
-            self._write_xyz(outfile)
+            self._write_xyz(outfile, fmt)
         elif(ext == '.dat' or ext == 'dat'):
-            self._write_dat(outfile, reverse)
+            self._write_dat(outfile, reverse, fmt)
         elif(ext == '.cif' or ext == 'cif'):
-            self._write_cif(outfile)
+            self._write_cif(outfile, fmt)
         return ''
 
-    def _write_dat(self, outfile=None, reverse=True):
-        if outfile is None: of = sys.stdout
-        else:               of = open(outfile,'w')
-        of.write(self.comment+'\n')
-        of.write('{0} atoms\n\n'.format(self.natoms))
-        of.write('{0} atom types\n\n'.format(len(self.atomtypes)))
-        of.write('{0} {1} xlo xhi\n'.format(-self.xsize/2,self.xsize/2))
-        of.write('{0} {1} ylo yhi\n'.format(-self.ysize/2,self.ysize/2))
-        of.write('{0} {1} zlo zhi\n\n'.format(-self.zsize/2,self.zsize/2))
-        of.write('Masses\n\n')
+    def _write_dat(self, outfile=None, reverse=True, fmt=None):
         atomtypes = list(self.atomtypes)
         atomtypes.sort()
         if reverse:
             atomtypes.reverse()
+        types = np.zeros(max(atomtypes+[0])+1, dtype=int)
+        types[atomtypes] = np.arange(1, len(atomtypes)+1)
+        lines = [self.comment+'\n']
+        lines.append('{0} atoms\n\n'.format(self.natoms))
+        lines.append('{0} atom types\n\n'.format(len(self.atomtypes)))
+        lines.append('{0} {1} xlo xhi\n'.format(-self.xsize/2,self.xsize/2))
+        lines.append('{0} {1} ylo yhi\n'.format(-self.ysize/2,self.ysize/2))
+        lines.append('{0} {1} zlo zhi\n\n'.format(-self.zsize/2,self.zsize/2))
+        lines.append('Masses\n\n')
         for i,z in enumerate(atomtypes):
-            of.write('{0} {1}\n'.format(i+1,round(masses.get_mass(z),2)))
-        of.write('\n')
-        of.write('Atoms\n\n')
-        for i,atom in enumerate(self.atoms):
-            of.write('{0} {1} {2} {3} {4}\n'.format(atom.id+1, atomtypes.index(atom.z)+1, atom.coord[0], atom.coord[1], atom.coord[2]))
-
-    def _write_xyz(self, outfile=None):
-        if outfile is None: of = sys.stdout
-        else:               of = open(outfile,'w')
-        of.write(str(self.natoms)+'\n')
-        of.write("{1} {2} {3} {0}\n".format(self.comment.strip(),self.xsize, self.xsize, self.zsize))
-        for i,atom in enumerate(self.atoms):
-            of.write(atom.realxyz()+'\n')
-
-    def _write_cif(self, outfile=None):
-        if outfile is None: of = sys.stdout
-        else:               of = open(outfile,'w')
-        of.write('_pd_phase_name\t'+self.comment+'\n')
-        of.write('_cell_length_a '+str(self.xsize)+'\n')
-        of.write('_cell_length_b '+str(self.ysize)+'\n')
-        of.write('_cell_length_c '+str(self.zsize)+'\n')
-        of.write('_cell_angle_alpha 90\n_cell_angle_beta 90\n_cell_angle_gamma 90\n')
-        of.write('_symmetry_space_group_name_H-M         \'P 1\'\n_symmetry_Int_Tables_number            1\n\n')
-        of.write('loop_\n_symmetry_equiv_pos_as_xyz\n   \'x, y, z\'\n\n')
-        of.write('loop_\n   _atom_site_label\n   _atom_site_occupancy\n   _atom_site_fract_x\n   _atom_site_fract_y\n   _atom_site_fract_z\n   _atom_site_adp_type\n   _atom_site_B_iso_or_equiv\n   _atom_site_type_symbol\n')
-        atomtypes = {}
-        for atom in self.atoms:
-            atomtypes[atom.z] = atomtypes.get(atom.z, 0) + 1
-            of.write('   '+znum2sym.z2sym(atom.z)+str(atomtypes[atom.z])+'\t1.0\t'+str(atom.coord[0]/self.xsize+0.5)+'\t'+str(atom.coord[1]/self.ysize+0.5)+'\t'+str(atom.coord[2]/self.zsize+0.5)+'\tBiso\t1.000000\t'+znum2sym.z2sym(atom.z)+'\n')
-        of.write('\n')
-        of.close()
+            lines.append('{0} {1}\n'.format(i+1,round(masses.get_mass(z),2)))
+        lines.append('\n')
+        lines.append('Atoms\n\n')
+        positions = self.positions
+        with _open_output(outfile) as of:
+            of.write(''.join(lines))
+            for block in _format_columns([self.ids+1, types[self.znums], positions[:,0], positions[:,1], positions[:,2]], fmt, sep=' '):
+                of.write(block)
+
+    def _write_xyz(self, outfile=None, fmt=None):
+        positions = self.positions
+        syms = [znum2sym.z2sym(z) for z in self.znums.tolist()]
+        lines = [str(self.natoms)+'\n']
+        lines.append("{1} {2} {3} {0}\n".format(self.comment.strip(),self.xsize, self.ysize, self.zsize))
+        with _open_output(outfile) as of:
+            of.write(''.join(lines))
+            for block in _format_columns([syms, positions[:,0], positions[:,1], positions[:,2]], fmt):
+                of.write(block)
+
+    def _write_cif(self, outfile=None, fmt=None):
+        lines = ['_pd_phase_name\t'+self.comment+'\n']
+        lines.append('_cell_length_a '+str(self.xsize)+'\n')
+        lines.append('_cell_length_b '+str(self.ysize)+'\n')
+        lines.append('_cell_length_c '+str(self.zsize)+'\n')
+        lines.append('_cell_angle_alpha 90\n_cell_angle_beta 90\n_cell_angle_gamma 90\n')
+        lines.append('_symmetry_space_group_name_H-M         \'P 1\'\n_symmetry_Int_Tables_number            1\n\n')
+        lines.append('loop_\n_symmetry_equiv_pos_as_xyz\n   \'x, y, z\'\n\n')
+        lines.append('loop_\n   _atom_site_label\n   _atom_site_occupancy\n   _atom_site_fract_x\n   _atom_site_fract_y\n   _atom_site_fract_z\n   _atom_site_adp_type\n   _atom_site_B_iso_or_equiv\n   _atom_site_type_symbol\n')
+        znums = self.znums
+        # Labels are the symbol followed by a running count per species, e.g. Cu1, Cu2, ...
+        count = np.zeros(len(znums), dtype=int)
+        for z in np.unique(znums):
+            mask = znums == z
+            count[mask] = np.arange(1, mask.sum()+1)
+        syms = [znum2sym.z2sym(z) for z in znums.tolist()]
+        labels = ['   '+sym+str(n) for sym,n in zip(syms, count.tolist())]
+        frac = self.positions/np.array([self.xsize, self.ysize, self.zsize]) + 0.5
+        n = len(znums)
+        with _open_output(outfile) as of:
+            of.write(''.join(lines))
+            for block in _format_columns([labels, ['1.0']*n, frac[:,0], frac[:,1], frac[:,2], ['Biso']*n, ['1.000000']*n, syms], fmt):
+                of.write(block)
+            of.write('\n')
 
     def __str__(self):
         return self.write()
@@ -266,71 +611,284 @@ class Model(object):
 
     @property
     def coordinates(self):
-        xx = np.fromfunction(lambda i: self.atoms[i].coord[0], self.natoms, dtype=np.float)
-        yy = np.fromfunction(lambda i: self.atoms[i].coord[1], self.natoms, dtype=np.float)
-        zz = np.fromfunction(lambda i: self.atoms[i].coord[2], self.natoms, dtype=np.float)
+        xx,yy,zz = self.positions.T
         return xx,yy,zz
 
-    def generate_neighbors(self, cutoff):
-        for atom in self.atoms:
-            atom.neighs = self.get_atoms_in_cutoff(atom,cutoff)
-            if(atom in atom.neighs): atom.neighs.remove(atom)
+    @property
+    def array_backed(self):
+        return isinstance(self.atoms, AtomArrays)
+
+    def to_arrays(self):
+        """ Switches the model to array-backed storage. """
+        if not self.array_backed:
+            self.atoms = AtomArrays.from_atoms(self.atoms)
+            if hasattr(self, 'hutch'):
+                self.hutch = Hutch(self)
+
+    @property
+    def positions(self):
+        """ (natoms,3) array of atom coordinates. For array-backed models this is a view
+            into the model's storage; otherwise it is a copy (use set_positions to write). """
+        if self.array_backed:
+            return self.atoms.positions
+        return np.array([atom.coord for atom in self.atoms], dtype=float).reshape((-1,3))
+
+    def set_positions(self, positions):
+        """ Sets the coordinates of every atom and moves the atoms whose hutch changed. """
+        positions = np.asarray(positions, dtype=float)
+        if self.array_backed:
+            self.atoms.positions[:] = positions
+        else:
+            for atom,coord in zip(self.atoms, positions.tolist()):
+                atom.coord = tuple(coord)
+        # The distances and vectors of the neighbor list no longer match the positions
+        self.__dict__.pop('neighbor_list', None)
+        if hasattr(self, 'hutch'):
+            self.hutch.update()
+
+    def move_atom(self, atom, coord):
+        """ Moves a single atom to coord, keeping the hutch up to date. """
+        self.__dict__.pop('neighbor_list', None)
+        if hasattr(self, 'hutch'):
+            self.hutch.move_atom(atom, coord)
+        else:
+            atom.coord = tuple(coord)
+
+    @property
+    def znums(self):
+        if self.array_backed:
+            return self.atoms.znums
+        return np.array([atom.z for atom in self.atoms], dtype=int)
+
+    @property
+    def ids(self):
+        if self.array_backed:
+            return self.atoms.ids
+        return np.array([atom.id for atom in self.atoms], dtype=int)
+
+    def generate_neighbors(self, cutoff, vectors=False, skin=0.0):
+        """ Sets atom.neighs and atom.cn for every atom and stores the neighbors as a
+            NeighborList in self.neighbor_list. If vectors is True the neighbor list also
+            keeps the displacement vector of every pair.
+            If skin > 0 the pairs within cutoff+skin are kept as a Verlet list so that
+            update_neighbors() can refresh the neighbors after small displacements
+            without searching the whole model again. """
+        if skin > 0:
+            if isinstance(cutoff, dict):
+                outer = dict((key,r+skin) for key,r in cutoff.items())
+            else:
+                outer = cutoff + skin
+            i, j, _ = self.hutch.get_all_neighbors(outer)
+            self._verlet = (cutoff, vectors, skin, self.positions.copy(), i, j)
+            self._filter_verlet_list()
+            return
+        self.__dict__.pop('_verlet', None)
+        self._set_neighbors(*self.hutch.get_all_neighbors(cutoff, vectors=vectors))
+
+    def _set_neighbors(self, i, j, d, vectors=None):
+        self.neighbor_list = NeighborList.from_pairs(self.natoms, i, j, d, vectors)
+        bounds = self.neighbor_list.offsets
+        atoms = self.atoms if not self.array_backed else list(self.atoms)
+        j = j.tolist()
+        for k,atom in enumerate(atoms):
+            atom.neighs = [atoms[x] for x in j[bounds[k]:bounds[k+1]]]
             atom.cn = len(atom.neighs)
+        self._neighbor_lists = [atom.neighs for atom in atoms]
+
+    def _keep_neighbor_list(self, nl):
+        """ Stores nl as self.neighbor_list for the current atom.neighs, which must hold the same neighbors. """
+        self.neighbor_list = nl
+        self._neighbor_lists = [atom.neighs for atom in self.atoms]
+
+    def _valid_neighbor_list(self):
+        """ Returns self.neighbor_list, or None if there is none or if atom.neighs was
+            reassigned or changed in place since it was built (scripts often filter
+            atom.neighs directly). A stale neighbor list is dropped. """
+        nl = self.__dict__.get('neighbor_list')
+        lists = self.__dict__.get('_neighbor_lists')
+        if nl is None or lists is None:
+            return nl
+        counts = nl.counts.tolist()
+        if len(lists) != self.natoms or len(counts) != self.natoms or \
+           any(atom.neighs is not neighs or len(neighs) != n for atom,neighs,n in zip(self.atoms, lists, counts)):
+            del self.neighbor_list
+            del self._neighbor_lists
+            return None
+        return nl
+
+    def get_neighbor_list(self):
+        """ Returns self.neighbor_list, or builds a NeighborList from atom.neighs if the
+            neighbors were set some other way or changed since generate_neighbors. """
+        nl = self._valid_neighbor_list()
+        if nl is not None:
+            return nl
+        i, j = [], []
+        for k,atom in enumerate(self.atoms):
+            if atom.neighs is None:
+                raise Exception("Atom {0} does not have neighbors.".format(atom))
+            neighs = sorted(self._slot_of(n) for n in atom.neighs)
+            i.extend([k]*len(neighs))
+            j.extend(neighs)
+        return NeighborList.from_pairs(self.natoms, np.array(i, dtype=int), np.array(j, dtype=int))
+
+    def _filter_verlet_list(self):
+        """ Sets the neighbors from the candidate pairs of the Verlet list using the current positions. """
+        cutoff, vectors, skin, _, i, j = self._verlet
+        znums = self.znums
+        d = self.minimum_image(self.positions[j] - self.positions[i])
+        r = np.sqrt(np.einsum('ij,ij->i', d, d))
+        keep = r < cutoff_matrix(cutoff)[znums[j], znums[i]]
+        self._set_neighbors(i[keep], j[keep], r[keep], d[keep] if vectors else None)
+
+    def update_neighbors(self):
+        """ Refreshes the neighbors after atoms have moved. The Verlet list from
+            generate_neighbors(cutoff, skin=...) is reused unless an atom has moved more
+            than half the skin since it was built. Returns True if a new search was needed. """
+        if not hasattr(self, '_verlet'):
+            raise Exception("You must call generate_neighbors with skin > 0 before update_neighbors.")
+        cutoff, vectors, skin, reference, _, _ = self._verlet
+        moved = self.minimum_image(self.positions - reference)
+        if np.max(np.einsum('ij,ij->i', moved, moved), initial=0.0) > (0.5*skin)**2:
+            self.generate_neighbors(cutoff, vectors, skin)
+            return True
+        self._filter_verlet_list()
+        return False
 
     def check_neighbors(self):
-        for atom in self.atoms:
-            for n in atom.neighs:
-                if atom not in n.neighs:
-                    print("You're neighbors are screwed up! Atom IDs are {0}, {1}.".format(atom.id,n.id))
-                    print("Neighbors of: {0}".format(atom))
-                    print(atom.neighs)
-                    print("Neighbors of: {0}".format(n))
-                    print(n.neighs)
-                    print("Dist = {0}".format(self.dist(atom,n)))
-                    print("Dist = {0}".format(self.dist(n,atom)))
+        nl = self._valid_neighbor_list()
+        if nl is not None:
+            # Only the asymmetric pairs need to be reported
+            pairs = zip(*nl.asymmetric_pairs())
+            pairs = [(self.atoms[i], self.atoms[j]) for i,j in pairs]
+        else:
+            pairs = [(atom,n) for atom in self.atoms for n in atom.neighs if atom not in n.neighs]
+        for atom,n in pairs:
+            print("You're neighbors are screwed up! Atom IDs are {0}, {1}.".format(atom.id,n.id))
+            print("Neighbors of: {0}".format(atom))
+            print(atom.neighs)
+            print("Neighbors of: {0}".format(n))
+            print(n.neighs)
+            print("Dist = {0}".format(self.dist(atom,n)))
+            print("Dist = {0}".format(self.dist(n,atom)))
+
+    def coordination_statistics(self):
+        """ Partial coordination numbers computed from the neighbor list (see get_neighbor_list).
+            Returns (species, average, partial):
+                species: sorted array of the elements in the model
+                average: (nspecies,nspecies) array; average[a,b] is the average number of
+                    neighbors of element species[b] around an atom of element species[a]
+                partial: (natoms,nspecies) int array; partial[i,b] is the number of neighbors
+                    of element species[b] around atom i (partial.sum(axis=1) is the CN) """
+        nl = self.get_neighbor_list()
+        species, types = np.unique(self.znums, return_inverse=True)
+        nspecies = len(species)
+        centers, neighs = nl.pairs()
+        partial = np.bincount(centers*nspecies + types[neighs], minlength=self.natoms*nspecies).reshape((self.natoms,nspecies))
+        totals = np.zeros((nspecies,nspecies), dtype=float)
+        np.add.at(totals, types, partial)
+        average = totals/np.bincount(types, minlength=nspecies)[:,None]
+        return species, average, partial
 
     def generate_average_coord_numbers(self):
         """ atom.neighs must be defined first for all atoms
             Form will be:
                 {'Cu-Al': 4.5, ... }
+            where 'Cu' alone is the average total coordination number of Cu.
+            See coordination_statistics for the same data as arrays.
         """
+        species, average, _ = self.coordination_statistics()
+        syms = [znum2sym.z2sym(z) for z in species.tolist()]
         coord_numbers = {}
-        for typea in self.atomtypes:
-            coord_numbers[znum2sym.z2sym(typea)] = 0
-            for typeb in self.atomtypes:
-                coord_numbers[znum2sym.z2sym(typea)+'-'+znum2sym.z2sym(typeb)] = 0
-        for atom in self.atoms:
-            for n in atom.neighs:
-                coord_numbers[znum2sym.z2sym(atom.z)] += 1
-                coord_numbers[znum2sym.z2sym(atom.z)+'-'+znum2sym.z2sym(n.z)] += 1
-        for key in coord_numbers:
-            elem = znum2sym.sym2z(key.split('-')[0])
-            coord_numbers[key] /= float(self.atomtypes[elem])
+        for a,syma in enumerate(syms):
+            coord_numbers[syma] = float(average[a].sum())
+            for b,symb in enumerate(syms):
+                coord_numbers[syma+'-'+symb] = float(average[a,b])
         return coord_numbers
 
     def get_atoms_in_cutoff(self,atom,cutoff):
         return self.hutch.get_atoms_in_radius(atom,cutoff)
 
+    @property
+    def cell_matrix(self):
+        """ 3x3 array whose rows are the box vectors. """
+        if self.cell is not None:
+            return self.cell
+        return np.diag([float(self.xsize), float(self.ysize), float(self.zsize)])
+
+    def fractional(self, coords):
+        """ Converts (...,3) coordinates to fractional coordinates, which are
+            between 0 and 1 for atoms inside the box. """
+        coords = np.asarray(coords, dtype=float)
+        if self.cell is None:
+            return coords/np.array([self.xsize, self.ysize, self.zsize], dtype=float) + 0.5
+        return coords.dot(np.linalg.inv(self.cell)) + 0.5
+
+    def minimum_image(self, d):
+        """ Applies the minimum image convention to an (...,3) array of displacements.
+            The array is modified in place and returned. """
+        if self.cell is None:
+            box = np.array([self.xsize, self.ysize, self.zsize], dtype=float)
+            d -= box*np.round(d/box)
+        else:
+            f = d.dot(np.linalg.inv(self.cell))
+            f -= np.round(f)
+            d[...] = f.dot(self.cell)
+        return d
+
     def dist(self, atom1, atom2, pbc=True):
-        x = (atom1.coord[0] - atom2.coord[0])
-        y = (atom1.coord[1] - atom2.coord[1])
-        z = (atom1.coord[2] - atom2.coord[2])
-        if pbc:
-            x = x - self.xsize*round(x/self.xsize)
-            y = y - self.ysize*round(y/self.ysize)
-            z = z - self.zsize*round(z/self.zsize)
-        return math.sqrt(x**2+y**2+z**2)
+        return math.sqrt(self.dist2(atom1, atom2, pbc))
 
     def dist2(self, atom1, atom2, pbc=True):
         x = (atom1.coord[0] - atom2.coord[0])
         y = (atom1.coord[1] - atom2.coord[1])
         z = (atom1.coord[2] - atom2.coord[2])
-        if pbc:
+        if pbc and self.cell is not None:
+            x,y,z = self.minimum_image(np.array([x,y,z])).tolist()
+        elif pbc:
             x = x - self.xsize*round(x/self.xsize)
             y = y - self.ysize*round(y/self.ysize)
             z = z - self.zsize*round(z/self.zsize)
         return x**2+y**2+z**2
 
+    def dist_one_to_many(self, center, indices=None, pbc=True, dtype=float):
+        """ Returns (vectors, distances) from 'center' (an atom or a coordinate) to the
+            atoms in 'indices' (every atom by default). vectors are the minimum image
+            displacements atom - center. Use dtype=np.float32 to halve the memory. """
+        coord = getattr(center, 'coord', center)
+        pos = self.positions if indices is None else self.positions[indices]
+        d = pos - np.asarray(coord, dtype=float)
+        if pbc:
+            self.minimum_image(d)
+        d = d.astype(dtype, copy=False)
+        return d, np.sqrt(np.einsum('ij,ij->i', d, d))
+
+    def dist_pairs(self, i, j, pbc=True, dtype=float):
+        """ Returns (vectors, distances) for the pairs of atom indices (i[k], j[k]).
+            vectors are the minimum image displacements from atom i to atom j. """
+        pos = self.positions
+        d = pos[j] - pos[i]
+        if pbc:
+            self.minimum_image(d)
+        d = d.astype(dtype, copy=False)
+        return d, np.sqrt(np.einsum('ij,ij->i', d, d))
+
+    def dist_many_to_many(self, rows=None, cols=None, blocksize=2**20, pbc=True, dtype=float):
+        """ Generator over blocks of the distance matrix between the atoms in 'rows' and
+            'cols' (all atoms by default). Each block is (row_indices, vectors, distances)
+            with shapes (b,), (b,ncols,3) and (b,ncols), where b is chosen so that a block
+            has at most blocksize distances (but at least one row). """
+        pos = self.positions
+        rows = np.arange(self.natoms) if rows is None else np.asarray(rows)
+        cpos = pos if cols is None else pos[cols]
+        nrows = max(1, blocksize//max(len(cpos), 1))
+        for lo in range(0, len(rows), nrows):
+            block = rows[lo:lo+nrows]
+            d = cpos[None,:,:] - pos[block][:,None,:]
+            if pbc:
+                self.minimum_image(d)
+            d = d.astype(dtype, copy=False)
+            yield block, d, np.sqrt(np.einsum('ijk,ijk->ij', d, d))
+
     def get_all_neighbor_distances(self):
         dists = []
         for atomi in self.atoms:
@@ -339,48 +897,89 @@ class Model(object):
                 dists.append( (atomi, atomj, self.dist(atomi,atomj)) )
         return dists
 
-    def nearest_neigh_of_same_type(self, atom, cutoff=3.5):
-        """ returns the nearest atom of the same species as 'atom' """
-        atoms = []
-        while(len(atoms) == 0):
-            atoms = self.get_atoms_in_cutoff(atom, cutoff)
-            atoms = [x for x in atoms if x.z == atom.z]
-            #if atom in atoms: atoms.remove(atom)
-            cutoff *= 2
-        cutoff /= 2 # set back to the value used in case I want it later
-        d = float("inf")
-        for atomi in atoms:
-            dt = self.dist(atom, atomi)
-            if dt < d:
-                d = dt
-                a = atomi
-        if(a.z != atom.z): raise Exception("Error! Function 'nearest_neigh_of_same_type' didn't work!")
-        return a
+    def _periodic_query(self, sources, queries, k=1):
+        """ Returns (distances, indices), both (len(queries),k), of the k nearest rows of
+            'sources' to every row of 'queries' using periodic images. Missing neighbors
+            (k > len(sources)) have distance inf and index len(sources). """
+        sources = np.asarray(sources, dtype=float).reshape((-1,3))
+        queries = np.asarray(queries, dtype=float).reshape((-1,3))
+        if self.cell is None:
+            box = np.array([self.xsize, self.ysize, self.zsize], dtype=float)
+            def wrap(x):
+                x = np.mod(x + box/2, box)
+                return np.where(x >= box, x - box, x) # np.mod can round up to box
+            tree = cKDTree(wrap(sources), boxsize=box)
+            d, idx = tree.query(wrap(queries), k=k)
+        else:
+            # cKDTree only handles orthogonal periodic boxes, so search the 27 images explicitly
+            wrap = lambda x: np.mod(self.fractional(x), 1.0).dot(self.cell)
+            shifts = _STENCIL.dot(self.cell)
+            tree = cKDTree((wrap(sources)[None,:,:] + shifts[:,None,:]).reshape((-1,3)))
+            d, idx = tree.query(wrap(queries), k=k)
+            n = len(sources)
+            idx = np.where(idx < tree.n, idx % max(n,1), n)
+        return d.reshape((-1,k)), idx.reshape((-1,k))
+
+    def nearest_neighbors(self, species=None, positions=None, znums=None):
+        """ Vectorized nearest-neighbor search with periodic images.
+            Returns (indices, distances): for every atom, the index in self.atoms of its
+            nearest other atom and the distance to it.
+            species: only atoms of this element (z) are candidates. If species='same',
+                the candidates for each atom are the atoms of its own element.
+            positions/znums: search for these points instead of the atoms of the model;
+                nothing is excluded then (znums is needed for species='same').
+            Points without any candidate get index -1 and distance inf. """
+        own = positions is None
+        if own:
+            positions, znums = self.positions, self.znums
+        else:
+            positions = np.asarray(positions, dtype=float).reshape((-1,3))
+            znums = None if znums is None else np.asarray(znums, dtype=int).reshape(-1)
+        n = len(positions)
+        indices = np.full(n, -1, dtype=int)
+        distances = np.full(n, np.inf)
+        if species == 'same':
+            if znums is None:
+                raise Exception("znums are needed to find the nearest atoms of the same species.")
+            groups = [(znums == z, self.znums == z) for z in np.unique(znums)]
+        elif species is None:
+            groups = [(np.ones(n, dtype=bool), np.ones(self.natoms, dtype=bool))]
+        else:
+            groups = [(np.ones(n, dtype=bool), self.znums == species)]
+        k = 2 if own else 1
+        for queries, candidates in groups:
+            q = np.flatnonzero(queries)
+            src = np.flatnonzero(candidates)
+            if len(q) == 0 or len(src) == 0:
+                continue
+            d, idx = self._periodic_query(self.positions[src], positions[q], k)
+            found = idx < len(src)
+            idx = np.where(found, src[np.minimum(idx, len(src)-1)], -1)
+            col = np.zeros(len(q), dtype=int)
+            if own:
+                col[idx[:,0] == q] = 1 # the nearest atom is the atom itself
+            rows = np.arange(len(q))
+            indices[q] = idx[rows,col]
+            distances[q] = d[rows,col]
+        return indices, distances
+
+    def nearest_neigh_of_same_type(self, atom):
+        """ returns the nearest atom of the same species as 'atom', other than atom itself """
+        # Skip atom itself (see Atom.__eq__)
+        candidates = (self.znums == atom.z) & ~np.all(np.round(self.positions,6) == np.round(atom.coord,6), axis=1)
+        src = np.flatnonzero(candidates)
+        if len(src) == 0:
+            raise Exception("Error! Function 'nearest_neigh_of_same_type' didn't work!")
+        _, idx = self._periodic_query(self.positions[src], [atom.coord])
+        return self.atoms[int(src[idx[0,0]])]
 
     def nearest_neigh(self, atom):
         """ returns an atoms nearest neighbor """
-        atoms = self.hutch.get_atoms_in_same_hutch(atom)[:]
-        if atom in atoms: atoms.remove(atom)
-
-        # This generation of nearby hutches isn't perfect but it will work
-        rots = [(1,0,0),(0,1,0),(0,0,1)]
-        i = 0
-        while len(atoms) == 0:
-            hutch = ((hutch[0]+rots[i][0])%self.hutch.nhutchs,(hutch[1]+rots[i][1])%self.hutch.nhutchs,(hutch[2]+rots[i][2])%self.hutch.nhutchs)
-            i = (i+1) % 3
-            atoms = self.hutch.hutchs[hutch]
-            if atom in atoms: atoms.remove(atom)
-        start = atoms[0]
-
-        atoms = self.get_atoms_in_cutoff(atom,self.dist(atom,start))
-        #if atom in atoms: atoms.remove(atom)
-        d = float("inf")
-        for atomi in atoms:
-            dt = self.dist(atom,atomi)
-            if dt < d:
-                d = dt
-                a = atomi
-        return a
+        _, d = self.dist_one_to_many(atom)
+        # Skip atom itself (see Atom.__eq__)
+        same = (self.znums == atom.z) & np.all(np.round(self.positions,6) == np.round(atom.coord,6), axis=1)
+        d[same] = np.inf
+        return self.atoms[int(np.argmin(d))]
 
     def print_bond_stats(self):
         # TODO Rewrite this function if I ever need it again. There was a "self.bonds = composition" line before the last for loop in "generate_average_coord_numbers" to define self.bonds, but I deleted that line.
@@ -399,117 +998,98 @@ class Model(object):
         print('Ratio of actual/expected bonds:')
         pprint(bond_stats)
 
-    def radial_composition(self, outfile):
-        """ Creates 1D waves stored in outfile for each element in the model. Each 
-        wave is a histogram of the number of atoms between two radial positions
-        starting at the center of model and radiating outward. """
-        # TODO Rewrite if I ever need this again
-        npix = 16
-        keys = self.atomtypes.keys()
-        #histo = [[0.0 for x in range(npix)] for key in keys]
-        histo = [{} for x in range(npix)]
-        dx = (self.xsize/2.0)/npix # Cube assumed
-        for i,r in enumerate(drange(dx, npix*dx-dx, dx)):
-            atoms = self.get_atoms_in_cutoff( (0.0,0.0,0.0), r)
-            print(r, len(atoms))
-            comp = {}
-            for atom in atoms:
-                comp[str(atom.z)] = comp.get(str(atom.z),0) + 1.0
-            for type in self.atomtypes:
-                if( str(type) not in comp.keys()):
-                    comp[str(type)] = 0.0
-            comp['Total'] = len(atoms)
-            histo[i] = comp
-        of = open(outfile,'w')
-        of.write('IGOR\n')
-        for atomtype in keys:
-            of.write('\nWAVES/N=({0})\t {1}\nBEGIN\n'.format(npix,'partial_radial_comp_'+znum2sym.z2sym(atomtype)))
-            for i in range(npix-2):
-                if(i != 0):
-                    of.write("{0} ".format((histo[i][str(atomtype)] - histo[i-1][str(atomtype)])/( 4.0/3.0*np.pi*( (i*dx)**3 - ((i-1)*dx)**3 ))))
-                    #print("{1}  {0} ".format(histo[i][str(atomtype)],i*dx))
-                    #print("  {1}  {0} ".format(histo[i][str(atomtype)] - histo[i-1][str(atomtype)],i*dx))
-                else:
-                    of.write("{0} ".format(histo[i][str(atomtype)]))
-                    #print("{1}  {0} ".format(histo[i][str(atomtype)],i*dx))
-            of.write("\n")
-            of.write('END\n')
-            of.write('X SetScale x 0,{1}, {0};\n'.format('partial_comp_'+znum2sym.z2sym(atomtype),npix*dx-dx))
-        of.close()
+    def radial_composition(self, outfile=None, npix=16):
+        """ Histograms the distance of every atom from the center of the model (0,0,0) into
+            npix shells of width (xsize/2)/npix, or for a triclinic cell half the smallest
+            distance between opposite faces over npix. Returns (edges, densities) where
+            densities[z] is the number density of element z in each shell. If outfile is
+            given the densities are also written there as 1D IGOR waves. """
+        if self.cell is None:
+            width = self.xsize # Cube assumed
+        else:
+            cell = self.cell_matrix
+            width = abs(np.linalg.det(cell))/np.linalg.norm(np.cross(cell[[1,2,0]], cell[[2,0,1]]), axis=1).min()
+        dx = (width/2.0)/npix
+        edges = np.arange(npix+1)*dx
+        _, d = self.dist_one_to_many((0.0,0.0,0.0))
+        volumes = 4.0/3.0*np.pi*(edges[1:]**3 - edges[:-1]**3)
+        znums = self.znums
+        densities = {}
+        for z in sorted(self.atomtypes):
+            counts, _ = np.histogram(d[znums == z], bins=edges)
+            densities[z] = counts/volumes
+        if outfile is not None:
+            waves = [('partial_radial_comp_'+znum2sym.z2sym(z), densities[z],
+                      'X SetScale x 0,{1}, {0};'.format('partial_radial_comp_'+znum2sym.z2sym(z), npix*dx)) for z in densities]
+            _write_igor(outfile, waves)
+        return edges, densities
 
-    def local_composition(self, outfile):
-        """ Variable radius sliding average Goes pixel by pixel and calculates the
-        composition around that pixel (within some radius) and assigns the center
-        pixel that composition. Use a 256 x 256 x 256 matrix. """
-        # TODO Rewrite if I ever need this again
-        radius = 3.6 * 2
-        npix = 64
-        #mat = np.zeros((npix,npix,npix),dtype=np.float)
-        #mat = np.zeros((npix,npix,npix),dtype={'names':['col1', 'col2', 'col3'], 'formats':['f4','f4','f4']})
-        #mat = np.zeros((npix,npix,npix),dtype={'names':['40', '13', '29'], 'formats':['f4','f4','f4']})
-        #mat = np.zeros((npix,npix,npix),dtype={'names':['id','data'], 'formats':['f4','f4']})
-        #names = ['id','data']
-        #formats = ['i4',('f4','f4','f4')]
-        #mat = np.zeros((npix,npix,npix),dtype=dict(names = names, formats=formats))
-        #mat = np.zeros((npix,npix,npix),dtype={'40':('i4',0), '29':('f4',0), '13':('f4',0)})
-        print("Creating matrix...")
-        mat = [[[{} for i in range(npix)] for j in range(npix)] for k in range(npix)]
-        print("Finished creating matrix.")
-        #print(repr(mat))
-        dx = self.xsize/npix
-        dy = self.ysize/npix
-        dz = self.zsize/npix
-        for ii,i in enumerate(drange(-npix/2*dx,npix/2*dx-dx,dx)):
-            print("On ii = {0}".format(ii))
-            for jj,j in enumerate(drange(-npix/2*dy,npix/2*dy-dy,dy)):
-                for kk,k in enumerate(drange(-npix/2*dz,npix/2*dz-dz,dz)):
-                    atoms = self.get_atoms_in_cutoff( (i,j,k), radius )
-                    comp = {}
-                    for atom in atoms:
-                        comp[str(atom.z)] = comp.get(str(atom.z),0) + 1.0
-                    for key in comp:
-                        comp[key] /= len(atoms)
-                    #print(comp)
-                    #mat[ii][jj][kk] = copy.copy(comp)
-                    mat[ii][jj][kk] = comp
-        of = open(outfile,'w')
-        of.write('IGOR\n')
-        for atomtype in self.atomtypes:
-            of.write('\nWAVES/N=({0},{1},{2})\t {3}\nBEGIN\n'.format(npix,npix,npix,'partial_comp_'+znum2sym.z2sym(atomtype)))
-            for layer in mat:
-                for column in layer:
-                    for value in column:
-                        try:
-                            of.write("{0} ".format(value[str(atomtype)]))
-                        except KeyError:
-                            of.write("{0} ".format(0.0))
-                of.write("\n")
-            of.write('END\n')
-            of.write('X SetScale/P x 0,1,"", {0}; SetScale/P y 0,1,"", {0}; SetScale/P z 0,1,"", {0}; SetScale d 0,0,"", {0}\n'.format('partial_comp_'+znum2sym.z2sym(atomtype)))
-        of.close()
-        return mat
+    def local_composition(self, outfile=None, radius=7.2, npix=64, oversample=1):
+        """ Variable radius sliding average. Calculates the composition within 'radius' of every
+            point of an npix x npix x npix grid spanning the box (starting at the -x,-y,-z corner).
+            The grid follows the box vectors, so for a triclinic cell it is a grid of fractional
+            coordinates.
+            Atoms are counted onto a grid (oversample times finer than the output) and the counts
+            are convolved with a spherical kernel using FFTs, so the sphere is resolved to the
+            size of a grid cell. Periodic boundaries are used.
+            Returns a dictionary of (npix,npix,npix) arrays: the fraction of element z around each
+            grid point (0 where there are no atoms). If outfile is given the arrays are also
+            written there as 3D IGOR waves. """
+        n = npix*oversample
+        cell = self.cell_matrix
+        # Counts of each element on the nearest grid point
+        cells = np.rint(self.fractional(self.positions)*n).astype(int) % n
+        flat = np.ravel_multi_index(cells.T, (n,n,n))
+        # Spherical kernel, with offsets wrapped periodically to their nearest image
+        offsets = np.fft.fftfreq(n, d=1.0/n)/n
+        fx, fy, fz = np.meshgrid(offsets, offsets, offsets, indexing='ij')
+        r2 = np.full((n,n,n), np.inf)
+        for shift in _STENCIL:
+            x, y, z = [(fx+shift[0])*cell[0,k] + (fy+shift[1])*cell[1,k] + (fz+shift[2])*cell[2,k] for k in range(3)]
+            r2 = np.minimum(r2, x**2 + y**2 + z**2)
+        kernel = np.fft.rfftn((r2 <= radius**2).astype(float))
+        znums = self.znums
+        counts = {}
+        for z in sorted(self.atomtypes):
+            grid = np.bincount(flat[znums == z], minlength=n**3).reshape((n,n,n)).astype(float)
+            counts[z] = np.rint(np.fft.irfftn(np.fft.rfftn(grid)*kernel, s=(n,n,n)))[::oversample,::oversample,::oversample]
+        total = sum(counts.values())
+        comp = {}
+        for z in counts:
+            comp[z] = np.divide(counts[z], total, out=np.zeros_like(total), where=total > 0)
+        if outfile is not None:
+            waves = [('partial_comp_'+znum2sym.z2sym(z), comp[z],
+                      'X SetScale/P x 0,1,"", {0}; SetScale/P y 0,1,"", {0}; SetScale/P z 0,1,"", {0}; SetScale d 0,0,"", {0}'.format('partial_comp_'+znum2sym.z2sym(z))) for z in comp]
+            _write_igor(outfile, waves)
+        return comp
+
+    def spatial_hash(self, tol=1e-6):
+        """ Returns a SpatialHash of this model's atoms (see spatial_hash.py). """
+        return SpatialHash(self.positions, self.znums, tol)
+
+    def match(self, other, tol=1e-6):
+        """ Returns an array holding, for every atom in self, the index in other.atoms of an
+            atom of the same element whose coordinates are all within tol, or -1 if there is none. """
+        return other.spatial_hash(tol).query(self.positions, self.znums)
 
-    def compare(self, m2):
-        """ Compares self and m2. An exception is raised if every atom in self is not found in m2 (but not vice versa). """
+    def diff(self, other, tol=1e-6):
+        """ Returns the indices of the atoms in self that are not in other (see match). """
+        return np.flatnonzero(self.match(other, tol) < 0)
+
+    def compare(self, m2, tol=1e-6):
+        """ Compares self and m2. An exception is raised if every atom in self is not found in m2 (but not vice versa).
+            Returns the index in m2.atoms of every atom in self. """
         assert self.natoms == m2.natoms
-        for atom1 in self.atoms:
-            found = False
-            for atom2 in m2.atoms:
-                if(atom1 == atom2):
-                    found = True
-                    break
-            else:
-                raise Exception("Atom not found! {0}".format(atom1))
-        else:
-            pass
+        mapping = self.match(m2, tol)
+        missing = np.flatnonzero(mapping < 0)
+        if len(missing):
+            raise Exception("Atom not found! {0}".format(self.atoms[missing[0]]))
+        return mapping
 
     def recenter(self, debug=False):
-        xmin = min(atom.coord[0] for atom in self.atoms)
-        xmax = max(atom.coord[0] for atom in self.atoms)
-        ymin = min(atom.coord[1] for atom in self.atoms)
-        ymax = max(atom.coord[1] for atom in self.atoms)
-        zmin = min(atom.coord[2] for atom in self.atoms)
-        zmax = max(atom.coord[2] for atom in self.atoms)
+        positions = self.positions
+        xmin, ymin, zmin = positions.min(axis=0).tolist()
+        xmax, ymax, zmax = positions.max(axis=0).tolist()
         if(debug):
             print("Original x-min/max = ({0},{1}".format(xmin,xmax))
             print("Original y-min/max = ({0},{1}".format(ymin,ymax))
@@ -519,43 +1099,53 @@ class Model(object):
         zcenter = zmin + (zmax - zmin)/2.0
         if(debug):
             print("Center was at ({0},{1},{2})".format(xcenter,ycenter,zcenter))
-        for i in range(self.natoms):
-            self.atoms[i].coord = ( self.atoms[i].coord[0] - xcenter, self.atoms[i].coord[1] - ycenter, self.atoms[i].coord[2] - zcenter )
+        self.set_positions(positions - np.array([xcenter, ycenter, zcenter]))
         if(debug):
-            xmin = min(atom.coord[0] for atom in self.atoms)
-            xmax = max(atom.coord[0] for atom in self.atoms)
+            positions = self.positions
+            xmin, ymin, zmin = positions.min(axis=0).tolist()
+            xmax, ymax, zmax = positions.max(axis=0).tolist()
             print("Original x-min/max = ({0},{1}".format(xmin,xmax))
-            ymin = min(atom.coord[1] for atom in self.atoms)
-            ymax = max(atom.coord[1] for atom in self.atoms)
             print("Original y-min/max = ({0},{1}".format(ymin,ymax))
-            zmin = min(atom.coord[2] for atom in self.atoms)
-            zmax = max(atom.coord[2] for atom in self.atoms)
             print("Original z-min/max = ({0},{1}".format(zmin,zmax))
             xcenter = round(xmin + (xmax - xmin)/2.0,15)
             ycenter = round(ymin + (ymax - ymin)/2.0,15)
             zcenter = round(zmin + (zmax - zmin)/2.0,15)
             print("Center is at ({0},{1},{2})".format(xcenter,ycenter,zcenter))
 
+    def region(self, mask, comment=None):
+        """ Returns a ModelView of the atoms where the boolean array 'mask' is True. """
+        indices = np.flatnonzero(mask)
+        if isinstance(self, ModelView) and self.parent is not None:
+            return ModelView(self.parent, self.indices[indices], comment)
+        return ModelView(self, indices, comment)
+
+    def box_region(self, lower, upper, comment=None):
+        """ A ModelView of the atoms strictly inside the box between the corners 'lower' and 'upper'. """
+        positions = self.positions
+        mask = np.all((positions > np.asarray(lower, dtype=float)) & (positions < np.asarray(upper, dtype=float)), axis=1)
+        return self.region(mask, comment)
+
+    def sphere_region(self, center, radius, comment=None):
+        """ A ModelView of the atoms within 'radius' of 'center' (an atom or a coordinate), using periodic images. """
+        _, d = self.dist_one_to_many(center)
+        return self.region(d <= radius, comment)
+
+    def slab_region(self, axis, lower, upper, comment=None):
+        """ A ModelView of the atoms with lower < coordinate < upper along 'axis' (0, 1 or 2). """
+        x = self.positions[:,axis]
+        return self.region((x > lower) & (x < upper), comment)
+
     def crop(self, xstart, xend, ystart, yend, zstart, zend):
-        atoms = []
-        for atom in self.atoms:
-            if( xstart < atom.coord[0] < xend and
-                ystart < atom.coord[1] < yend and
-                zstart < atom.coord[2] < zend):
-                atoms.append(atom)
-        newm = Model('cropped model',2*abs(xend)+2*abs(xstart),2*abs(yend)+2*abs(ystart),2*abs(zend)+2*abs(zstart),atoms)
+        view = self.box_region((xstart,ystart,zstart), (xend,yend,zend))
+        newm = view.materialize(comment='cropped model', xsize=2*abs(xend)+2*abs(xstart), ysize=2*abs(yend)+2*abs(ystart), zsize=2*abs(zend)+2*abs(zstart))
         newm.recenter()
         return newm
 
     def min_dist(self):
-        # TODO Can use the function "find_nearest_neighbor" and that should make this much faster
-        m = float("inf")
-        for i,atomi in enumerate(self.atoms):
-            for atomj in self.atoms[self.atoms.index(atomi)+1:]:
-                d = self.dist(atomi, atomj)
-                if(d < m):
-                    m = d
-                    t = (atomi,atomj)
+        indices, distances = self.nearest_neighbors()
+        i = int(np.argmin(distances))
+        m = float(distances[i])
+        t = (self.atoms[i], self.atoms[int(indices[i])])
         print("\nMinimimum atomic spacing: {0} from atoms {1}\n".format(m,t))
         return m, t
 
@@ -583,34 +1173,55 @@ class Model(object):
         zz = [atom.coord[2] for atom in self.atoms]
         print('x-min: {0}\t x-max: {1}'.format(min(xx),max(xx)))
 
-    def combine(self, *models):
-        m0 = self.copy()
+    def combine(self, *models, **kwargs):
+        """ Returns a new model with the atoms of self followed by the atoms of each model
+            in 'models' that are not already in it (see match; keyword tol=1e-6).
+            If return_mappings=True, (model, mappings) is returned instead, where
+            mappings[k][i] is the index in the new model of atom i of models[k].
+            The added atoms are given new ids following the largest id in the model. """
+        tol = kwargs.pop('tol', 1e-6)
+        return_mappings = kwargs.pop('return_mappings', False)
+        if kwargs:
+            raise TypeError("Unexpected keyword arguments {0}".format(list(kwargs)))
+        m0 = Model(comment=self.comment, xsize=self.xsize, ysize=self.ysize, zsize=self.zsize, cell=self.cell, atoms=self.atoms)
+        mappings = []
         for m in models:
-            for atom in m.atoms:
-                if atom not in m0.atoms:
-                    m0.add(atom)
+            mapping = m.match(m0, tol)
+            new = np.flatnonzero(mapping < 0)
+            # Atoms repeated within m are only added once
+            first = SpatialHash(m.positions[new], m.znums[new], tol).first_occurrence()
+            unique = first == np.arange(len(new))
+            mapping[new[unique]] = m0.natoms + np.arange(unique.sum())
+            mapping[new] = mapping[new[first]]
+            atoms = [m.atoms[i].copy() for i in new[unique].tolist()]
+            start = int(m0.ids.max())+1 if m0.natoms else 0
+            for i,atom in enumerate(atoms):
+                atom.id = start + i
+            m0.add_many(atoms)
+            mappings.append(mapping)
+        if return_mappings:
+            return m0, mappings
         return m0
 
+    def supercell(self, nx, ny=None, nz=None, arrays=False):
+        """ Returns a new model made of nx*ny*nz copies of this one along its box vectors
+            (ny and nz default to nx). The new box is centered on the origin like the original.
+            Atoms are numbered 0..N-1, image by image, each image in the order of self.atoms. """
+        if ny is None: ny = nx
+        if nz is None: nz = nx
+        reps = np.array([nx,ny,nz])
+        cell = self.cell_matrix
+        images = np.array(list(itertools.product(range(nx),range(ny),range(nz))), dtype=float)
+        shifts = (images - (reps-1)/2.0).dot(cell)
+        positions = (shifts[:,None,:] + self.positions[None,:,:]).reshape((-1,3))
+        znums = np.tile(self.znums, len(images))
+        return Model.from_arrays(znums, positions, comment=self.comment,
+                                 xsize=self.xsize*nx, ysize=self.ysize*ny, zsize=self.zsize*nz,
+                                 cell=None if self.cell is None else cell*reps[:,None], arrays=arrays)
+
     def generate_larger_model(self, mult):
-        # This is slow because I am adding atoms one at a time
-        model = Model(xsize=self.xsize*mult, ysize=self.ysize*mult, zsize=self.zsize*mult, atoms=[])
-        natoms = 0
-        for atom in self.atoms:
-            for i in range(mult):
-                for j in range(mult):
-                    for k in range(mult):
-                        if(i == j == k == 0): continue
-                        natoms += 1
-                        x = atom.coord[0] + i*model.xsize
-                        y = atom.coord[1] + j*model.ysize
-                        z = atom.coord[2] + k*model.zsize
-                        model.add_atom(Atom(natoms, atom.z, x, y, z))
-
-        # Shift right 1/2 world and left mult/2 worlds
-        # which is equivalent to left (mult-1)/2 worlds
-        for i,atom in enumerate(model.atoms):
-            model.atoms[i].set_coord(model.atoms[i].coord[0] - (mult-1)/2.0*model.xsize, model.atoms[i].coord[1] - (mult-1)/2.0*model.ysize, model.atoms[i].coord[2] - (mult-1)/2.0*model.zsize)
-        return model
+        """ Returns the mult x mult x mult supercell of this model (see supercell). """
+        return self.supercell(mult)
 
     def icofrac(self):
         """ Sets the atom.z for all atoms in self to be a number between 0 and nbins based on the fraction of pentagonal VP faces. """
@@ -624,33 +1235,14 @@ class Model(object):
         fracs.sort()
         print('Min %: {0}. Max %: {1}'.format(min(fracs),max(fracs)))
 
-    def bond_angle_distribution(m, nbins=None, dtheta=None):
-        if nbins is None:
-            nbins = np.pi/dtheta
-        elif dtheta is None:
-            dtheta = np.pi/nbins
-        else:
-            raise Exception("Either nbins or dtheta must be specified.")
-        divisor = 0
-        hist = np.zeros(nbins+1, np.int)
-        for atomi in m.atoms:
-            for j in range(0,atomi.cn):
-                rij = m.dist(atomi,atomi.neighs[j])
-                for k in range(j+1,atomi.cn):
-                    rik = m.dist(atomi,atomi.neighs[k])
-                    rjk = m.dist(atomi.neighs[j],atomi.neighs[k])
-                    temp = round( (rij**2 + rik**2 - rjk**2)/(2.0*rij*rik) , 10 )
-                    tijk = acos(temp)
-                    bin = int(tijk/dtheta)
-                    hist[bin] += 1
-            divisor += atomi.cn*(atomi.cn-1)
-        #if(divisor > 0):
-        #    hist = [float(x)/float(divisor)*200 for x in hist]
-
-        dtheta = np.arange(0.0,180.0+dtheta*180.0/np.pi,dtheta*180.0/np.pi)
-        return dtheta,hist
-
-    def voronoi(self, atom=None, atoms=None, cutoff=None, atol=0.03, tol=0.03, tltol=0.03):
+    def bond_angle_distribution(self, nbins=None, dtheta=None, partial=False, chunksize=1000000):
+        """ See bond_angle_distribution.bad. """
+        return bond_angle_distribution.bad(self, nbins, dtheta, partial, chunksize)
+
+    def voronoi(self, atom=None, atoms=None, cutoff=None, atol=0.03, tol=0.03, tltol=0.03, nprocs=1, cache=None):
+        """ Computes the VP of atom, of the atoms in the list atoms, or of every atom.
+            For every atom this is voronoi_3d.vp_anaysizesis, which can use nprocs processes
+            and the on-disk vp_cache (cache=True, or None and VP_CACHE=1). """
         if atoms is not None and isinstance(atoms, list):
             for atom in atoms:
                 if atom.neighs is None:
@@ -661,18 +1253,167 @@ class Model(object):
                 raise Exception("Atom {0} does not have neighbors.".format(atom))
             voronoi_3d.calculate_atom(self, atom, cutoff, atol=0.03, tol=0.03, tltol=0.03)
         else:
-            self.voronoi(atoms=self.atoms, atol=atol, tol=tol, tltol=tltol)
+            voronoi_3d.vp_anaysizesis(self, cutoff, tol, atol, tltol, nprocs=nprocs, cache=cache)
         return None
 
+    def _detach(self):
+        """ Does nothing: the atoms of a Model are its own (see ModelView._detach). """
+        pass
+
     def rotate(self, array=None, alpha=None, beta=None, gamma=None, degree=True, invert=True):
         rotate_3d.rotate(self, array, alpha, beta, gamma, degree, invert)
 
     def translate(self, vector):
-        for i,atom in enumerate(self.atoms):
-            old_coord = [atom.coord[0], atom.coord[1], atom.coord[2]]
-            new_coord = (old_coord[0] + vector[0], old_coord[1] + vector[1], old_coord[2] + vector[2])
-            atom.coord = (new_coord[0], new_coord[1], new_coord[2])
+        self.transform(shift=vector)
+
+    def transform(self, matrix=None, shift=None, center=False, wrap=False):
+        """ Applies a rigid transform to every atom at once:
+                positions = positions.dot(matrix) + shift
+            (coordinates are row vectors, as in rotate_3d). If center is True the middle of
+            the atoms' bounding box is first moved to the origin (see recenter), and if wrap
+            is True the atoms are put back into the periodic box afterwards. """
+        positions = self.positions
+        if center:
+            positions = positions - (positions.min(axis=0) + positions.max(axis=0))/2.0
+        if matrix is not None:
+            positions = positions.dot(np.asarray(matrix, dtype=float).reshape((3,3)))
+        if shift is not None:
+            positions = positions + np.asarray(shift, dtype=float)
+        if wrap:
+            positions = self.wrap(positions)
+        self.set_positions(positions)
+
+    def wrap(self, positions=None):
+        """ Returns 'positions' (the atom positions by default) mapped back into the periodic box. """
+        if positions is None:
+            positions = self.positions
+        frac = np.mod(self.fractional(positions), 1.0)
+        return (frac - 0.5).dot(self.cell_matrix)
+
+    def rotated_positions(self, matrices, indices=None):
+        """ Applies a stack of (k,3,3) rotation matrices (row-vector convention, see transform)
+            to the positions of the atoms in 'indices' (all by default) in one batched product.
+            Returns a (k,natoms,3) array; the model itself is not changed. """
+        positions = self.positions if indices is None else self.positions[indices]
+        matrices = np.asarray(matrices, dtype=float).reshape((-1,3,3))
+        return np.matmul(positions[None,:,:], matrices)
+
+
+
+def _copy_on_write(name):
+    method = getattr(Model, name)
+    def inner(self, *args, **kwargs):
+        self._detach()
+        return method(self, *args, **kwargs)
+    inner.__name__ = name
+    inner.__doc__ = method.__doc__
+    return inner
+
+
+class ModelView(Model):
+    """ A selection of the atoms of another model, see Model.region and the *_region methods.
+        A view only stores the indices of its atoms in the parent model: positions, znums and
+        ids are read from the parent's arrays and self.atoms are the parent's own atom objects.
+        The box is the parent's box, so distances are the same as in the parent.
+        Methods that add, remove or move atoms or set their neighbors or VPs (voronoi here, and
+        voronoi_3d, voronoi_scipy and cutoff_sweep) first copy the selected atoms, after which
+        the view is an ordinary standalone model. Until then the atoms are shared: changing
+        an attribute of view.atoms[i] directly changes the parent's atom too, and
+        voronoi_3d.calculate_atom raises rather than write into the parent.
+        Use materialize() to get a standalone copy with a different box. """
+    _mutators = ('add', 'add_many', 'remove', 'remove_many', 'set_positions', 'move_atom',
+                 'translate', 'rotate', 'recenter', 'generate_neighbors', 'update_neighbors', 'to_arrays')
+
+    def __init__(self, parent, indices, comment=None):
+        self.parent = parent
+        self.indices = np.asarray(indices, dtype=int)
+        self.filename = None
+        self.comment = parent.comment if comment is None else comment
+        self.xsize, self.ysize, self.zsize = parent.xsize, parent.ysize, parent.zsize
+        self.cell = parent.cell
+        self.natoms = len(self.indices)
+        self.atomtypes = Counter(self.znums.tolist())
+
+    @property
+    def atoms(self):
+        if self.parent is None:
+            return self.__dict__['_atoms']
+        if '_atoms' not in self.__dict__:
+            atoms = self.parent.atoms
+            self.__dict__['_atoms'] = [atoms[i] for i in self.indices.tolist()]
+        return self.__dict__['_atoms']
+    @atoms.setter
+    def atoms(self, atoms):
+        self.parent = None
+        self.__dict__['_atoms'] = atoms
+
+    @property
+    def array_backed(self):
+        return self.parent is None and isinstance(self.atoms, AtomArrays)
+
+    @property
+    def positions(self):
+        if self.parent is None:
+            return Model.positions.fget(self)
+        return self.parent.positions[self.indices]
+
+    @property
+    def znums(self):
+        if self.parent is None:
+            return Model.znums.fget(self)
+        return self.parent.znums[self.indices]
+
+    @property
+    def ids(self):
+        if self.parent is None:
+            return Model.ids.fget(self)
+        return self.parent.ids[self.indices]
+
+    @property
+    def hutch(self):
+        if 'hutch' not in self.__dict__:
+            self.__dict__['hutch'] = Hutch(self)
+        return self.__dict__['hutch']
+    @hutch.setter
+    def hutch(self, hutch):
+        self.__dict__['hutch'] = hutch
+
+    def _detach(self):
+        """ Replaces the shared atoms by copies so that the view can be modified. """
+        if self.parent is None:
+            return
+        arrays = self.parent.array_backed
+        znums, positions, ids = self.znums, self.positions, self.ids
+        self.__dict__.pop('_atoms', None)
+        self._set_atoms(znums, positions, arrays, ids)
+        self.hutch = Hutch(self)
+
+    def voronoi(self, atom=None, atoms=None, *args, **kwargs):
+        """ Model.voronoi on copies of the selected atoms; atom and atoms (atoms of the view)
+            are replaced by their copies. The copies have no neighbors yet. """
+        slot = None if atom is None else self._slot_of(atom)
+        slots = None if atoms is None else [self._slot_of(a) for a in atoms]
+        self._detach()
+        if slot is not None:
+            atom = self.atoms[slot]
+        if slots is not None:
+            atoms = [self.atoms[i] for i in slots]
+        return Model.voronoi(self, atom, atoms, *args, **kwargs)
+
+    def materialize(self, comment=None, xsize=None, ysize=None, zsize=None):
+        """ Returns a standalone Model with copies of the selected atoms. The box is the
+            parent's unless sizes are given. Neighbors and VPs are not copied. """
+        if xsize is None and ysize is None and zsize is None:
+            xsize, ysize, zsize, cell = self.xsize, self.ysize, self.zsize, self.cell
+        else:
+            cell = None
+        return Model.from_arrays(self.znums, self.positions, self.ids,
+                                 comment=self.comment if comment is None else comment,
+                                 xsize=xsize, ysize=ysize, zsize=zsize, cell=cell,
+                                 arrays=self.parent.array_backed if self.parent is not None else self.array_backed)
 
+for _name in ModelView._mutators:
+    setattr(ModelView, _name, _copy_on_write(_name))
 
 
 def main():
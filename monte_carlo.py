@@ -36,11 +36,7 @@ class MonteCarlo(object):
         if(arr.shape == (9,)): arr = arr.reshape((3,3))
         #print(arr)
         arr = np.linalg.inv(arr)
-        
-        for i,atom in enumerate(model.atoms):
-            old_coord = [atom.coord[0], atom.coord[1], atom.coord[2]]
-            new_coord = np.dot(np.asarray(old_coord), arr)
-            atom.coord = (new_coord[0],new_coord[1],new_coord[2])
+        model.transform(arr)
 
 
     def calc_rot_array(self, t1, t2, t3, deg=True):
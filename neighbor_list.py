@@ -0,0 +1,64 @@
+import numpy as np
+
+
+class NeighborList(object):
+    """ Compressed-sparse-row neighbor list.
+        The neighbors of atom i (its position in model.atoms) are
+            indices[offsets[i]:offsets[i+1]]
+        sorted in increasing order. distances and vectors (displacements from
+        atom i to each neighbor, minimum image) are optional and aligned with indices. """
+
+    def __init__(self, offsets, indices, distances=None, vectors=None):
+        self.offsets = np.asarray(offsets, dtype=int)
+        self.indices = np.asarray(indices, dtype=int)
+        self.distances = distances
+        self.vectors = vectors
+
+    @classmethod
+    def from_pairs(cls, natoms, i, j, distances=None, vectors=None):
+        """ Builds the list from pair arrays that are sorted by i then j
+            (e.g. the output of Hutch.get_all_neighbors). """
+        offsets = np.searchsorted(i, np.arange(natoms+1))
+        return cls(offsets, j, distances, vectors)
+
+    @property
+    def natoms(self):
+        return len(self.offsets) - 1
+
+    def __len__(self):
+        return self.natoms
+
+    def __getitem__(self, i):
+        return self.indices[self.offsets[i]:self.offsets[i+1]]
+
+    @property
+    def counts(self):
+        """ Number of neighbors (coordination number) of every atom. """
+        return np.diff(self.offsets)
+
+    def centers(self):
+        """ Returns the center atom of every entry in self.indices. """
+        return np.repeat(np.arange(self.natoms), self.counts)
+
+    def pairs(self):
+        """ Returns (i, j) arrays of every neighbor pair. """
+        return self.centers(), self.indices
+
+    def contains(self, i, j):
+        """ Returns True if j is a neighbor of i. """
+        row = self[i]
+        k = np.searchsorted(row, j)
+        return k < len(row) and row[k] == j
+
+    def common(self, i, j):
+        """ Returns the sorted array of atoms that are neighbors of both i and j. """
+        return np.intersect1d(self[i], self[j], assume_unique=True)
+
+    def asymmetric_pairs(self):
+        """ Returns (i, j) arrays of the pairs where j is a neighbor of i but i is not a neighbor of j. """
+        i, j = self.pairs()
+        n = self.natoms
+        forward = i*n + j
+        backward = j*n + i
+        bad = ~np.isin(backward, forward)
+        return i[bad], j[bad]
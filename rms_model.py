@@ -3,19 +3,15 @@ import os
 import sys
 from model import Model
 import math
+import numpy as np
 
 
 def rms_closest(m1,m2):
     if m1.natoms != m2.natoms: raise Exception("Error! The two models don't have the same number of atoms!")
 
-    r = 0.0
-    for atomi in m1.atoms:
-        #m2.add_atom(atomi) # Need to add atomi to m2 for next function to work. Actually we don't!
-        closest = m2.nearest_neigh_of_same_type(atomi) # This works correctly
-        d = m1.dist(atomi,closest)
-        r += d**2
-        #m2.remove_atom(atomi)
-    r = math.sqrt(r/float(m1.natoms))
+    # The closest atom of the same type in m2 for every atom in m1
+    _, d = m2.nearest_neighbors(species='same', positions=m1.positions, znums=m1.znums)
+    r = math.sqrt(np.sum(d**2)/float(m1.natoms))
     return r
 
 
@@ -24,24 +20,18 @@ def rms(m1,m2):
 
     # This won't always be true, but assume atom 1 in m1
     # is atom 1 in m2.
-    r = 0.0
-    for i,atomi in enumerate(m1.atoms):
-        d = m1.dist(atomi,m2.atoms[i])
-        r += d**2
-    r = math.sqrt(r/float(m1.natoms))
+    d = m1.minimum_image(m2.positions - m1.positions)
+    r = math.sqrt(np.einsum('ij,ij->', d, d)/float(m1.natoms))
     return r
 
 
 def find_nearest_atom(atom,m):
     #return m.nearest_neigh(atom) # Not the same models! Actually that might not matter.
-    mind = 100000.0
-    for atomi in m.atoms:
-        if(atomi != atom):# and atom.z == atomi.z):
-            d = m.dist(atom,atomi)
-            if(d < mind):
-                mind = d
-                closest_atom = atomi
-    return closest_atom
+    _, d = m.dist_one_to_many(atom)
+    # Skip atom itself (see Atom.__eq__)
+    same = (m.znums == atom.z) & np.all(np.round(m.positions,6) == np.round(atom.coord,6), axis=1)
+    d[same] = np.inf
+    return m.atoms[int(np.argmin(d))]
 
 
 def main():
@@ -17,14 +17,13 @@ def rot(model, arr):
     """ arr should be a 9 element rotation numpy array, which we will reshape here """
     arr = arr.reshape((3,3))
     arr = np.linalg.inv(arr)
+    positions = model.positions
     if( all( i == 0 for elem in arr for i in elem )):
-        for i,atom in enumerate(model.atoms):
-            atom.set_coord(atom.coord[0],atom.coord[1],0)
+        positions[:,2] = 0
     else:
-        for i,atom in enumerate(model.atoms):
-            old_coord = [atom.coord[0], atom.coord[1], atom.coord[2]]
-            new_coord = np.dot(np.asarray(old_coord), arr)
-            atom.set_coord(new_coord[0],new_coord[1],0)#new_coord[2])
+        positions = positions.dot(arr)
+        positions[:,2] = 0 #new_coord[2]
+    model.set_positions(positions)
 
 def main():
     modelfile = sys.argv[1]
@@ -41,7 +41,8 @@ def calc_rot_array_from_hkl(h,k,l):
     return mat
 
 
-def rotate(model, array=None, alpha=None, beta=None, gamma=None, degree=True, invert=True):
+def rotation_matrix(array=None, alpha=None, beta=None, gamma=None, degree=True, invert=True):
+    """ Returns the 3x3 matrix that rotate() applies to the (row vector) coordinates. """
     if array is None:
         if alpha is None or beta is None or gamma is None:
             raise Exception("You must provide either an array or a set of angles: alpha, beta, gamma")
@@ -53,11 +54,11 @@ def rotate(model, array=None, alpha=None, beta=None, gamma=None, degree=True, in
         array = array.reshape((3,3))
     if invert:
         array = np.linalg.inv(array)
+    return array
+
 
-    for i,atom in enumerate(model.atoms):
-        old_coord = [atom.coord[0], atom.coord[1], atom.coord[2]]
-        new_coord = np.dot(np.asarray(old_coord), array)
-        atom.coord = (new_coord[0], new_coord[1], new_coord[2])
+def rotate(model, array=None, alpha=None, beta=None, gamma=None, degree=True, invert=True):
+    model.transform(rotation_matrix(array, alpha, beta, gamma, degree, invert))
 
 
 def calculate_rotation_array(t1, t2, t3, degree=True):
@@ -0,0 +1,70 @@
+import itertools
+import numpy as np
+
+
+def _hash(cells, znums):
+    """ Combines integer cell coordinates (N,3) and atomic numbers into one int64 key per row.
+        Different cells can share a key; matches are always checked against the positions. """
+    cells = cells.astype(np.int64)
+    keys = cells[:,0]*np.int64(73856093) ^ cells[:,1]*np.int64(19349663) ^ cells[:,2]*np.int64(83492791)
+    if znums is not None:
+        keys ^= np.asarray(znums, dtype=np.int64)*np.int64(2654435761)
+    return keys
+
+
+class SpatialHash(object):
+    """ Finds atoms at (nearly) the same position in near-linear time.
+        Positions are quantized onto a grid of cells 2*tol wide and the cells are hashed.
+        A point within tol of a stored atom must be in the point's own cell or in the
+        neighboring cell on the side of the cell it is closest to, so a query only
+        looks at 8 cells.
+        Two atoms match if every coordinate differs by at most tol and, when znums
+        are given, they are the same element. """
+
+    def __init__(self, positions, znums=None, tol=1e-6):
+        self.positions = np.asarray(positions, dtype=float).reshape((-1,3))
+        self.znums = None if znums is None else np.asarray(znums, dtype=int)
+        self.tol = tol
+        self.width = 2.0*tol
+        keys = _hash(np.floor(self.positions/self.width), self.znums)
+        self._order = np.argsort(keys, kind='mergesort')
+        self._keys = keys[self._order]
+
+    def __len__(self):
+        return len(self.positions)
+
+    def query(self, positions, znums=None):
+        """ Returns, for every row of 'positions', the smallest index of a matching stored
+            atom, or -1 if there is none. """
+        positions = np.asarray(positions, dtype=float).reshape((-1,3))
+        if znums is not None:
+            znums = np.asarray(znums, dtype=int)
+        n = len(positions)
+        best = np.full(n, len(self), dtype=int)
+        if n == 0 or len(self) == 0:
+            return np.full(n, -1, dtype=int)
+        scaled = positions/self.width
+        cells = np.floor(scaled)
+        side = np.where(scaled - cells >= 0.5, 1, -1)
+        for offset in itertools.product((0,1), repeat=3):
+            keys = _hash(cells + side*np.array(offset), znums)
+            lo = np.searchsorted(self._keys, keys, side='left')
+            hi = np.searchsorted(self._keys, keys, side='right')
+            counts = hi - lo
+            total = counts.sum()
+            if total == 0:
+                continue
+            q = np.repeat(np.arange(n), counts)
+            within = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            cand = self._order[np.repeat(lo, counts) + within]
+            ok = np.all(np.abs(self.positions[cand] - positions[q]) <= self.tol, axis=1)
+            if znums is not None and self.znums is not None:
+                ok &= self.znums[cand] == znums[q]
+            np.minimum.at(best, q[ok], cand[ok])
+        best[best == len(self)] = -1
+        return best
+
+    def first_occurrence(self):
+        """ For every stored atom, the smallest index of an atom matching it
+            (its own index if it is the first of its duplicates). """
+        return self.query(self.positions, self.znums)
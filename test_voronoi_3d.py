@@ -0,0 +1,124 @@
+""" Checks that the numpy vertex enumeration of voronoi_3d (work_numpy) gives the same
+    polyhedra as the original python one (work).
+    Run with: python -m pytest test_voronoi_3d.py """
+import numpy as np
+import pytest
+from model import Model
+import voronoi_3d
+
+TOL = 0.03
+CUTOFF = 3.6
+
+
+def fcc_model(n=3, a=3.6, noise=0.1, seed=0):
+    """ An n x n x n fcc box of Cu/Zr/Al with gaussian noise on the positions. """
+    rng = np.random.RandomState(seed)
+    base = np.array([[0,0,0],[.5,.5,0],[.5,0,.5],[0,.5,.5]])
+    cells = np.array([[i,j,k] for i in range(n) for j in range(n) for k in range(n)])
+    positions = (cells[:,None,:] + base[None,:,:]).reshape((-1,3))*a - n*a/2.0 + 0.01
+    positions += rng.normal(0, noise, positions.shape)
+    znums = rng.choice([13, 29, 40], len(positions))
+    return Model.from_arrays(znums, positions, xsize=n*a, ysize=n*a, zsize=n*a)
+
+
+def random_packing(natoms=120, size=13.0, rmin=2.3, seed=0):
+    """ Random sequential packing: random points that are at least rmin apart (periodic). """
+    rng = np.random.RandomState(seed)
+    positions = np.zeros((0,3))
+    while len(positions) < natoms:
+        x = rng.uniform(-size/2, size/2, 3)
+        d = positions - x
+        d -= size*np.round(d/size)
+        if not len(d) or np.einsum('ij,ij->i', d, d).min() >= rmin**2:
+            positions = np.vstack((positions, x))
+    znums = rng.choice([13, 29, 40], natoms)
+    return Model.from_arrays(znums, positions, xsize=size, ysize=size, zsize=size)
+
+
+def outcome(engine, p):
+    """ (nv, nf, ne, nepf, sorted vertices) of the VP from engine, or the MyError message. """
+    try:
+        nv,nf,ne,nepf,nloop,mvijk,v = voronoi_3d.engines[engine](len(p), TOL, p)
+    except voronoi_3d.MyError as inst:
+        return str(inst)
+    v = np.array(v, dtype=float)
+    return nv, nf, ne, list(nepf), v[np.lexsort(v.T[::-1])]
+
+
+def assert_same_polyhedra(model):
+    model.generate_neighbors(CUTOFF)
+    for atom in model.atoms:
+        p, _ = voronoi_3d.candidates(model, atom, CUTOFF)
+        ref, new = outcome('python', p), outcome('numpy', p)
+        if isinstance(ref, str) or isinstance(new, str):
+            assert ref == new, atom
+            continue
+        assert ref[:4] == new[:4], atom
+        assert np.allclose(ref[4], new[4], rtol=0.0, atol=1e-9), atom
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_jittered_fcc(seed):
+    assert_same_polyhedra(fcc_model(noise=0.1, seed=seed))
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_random_packing(seed):
+    assert_same_polyhedra(random_packing(seed=seed))
+
+
+def test_degenerate_input():
+    # A perfect lattice has vertices shared by more than three planes
+    model = fcc_model(noise=0.0)
+    model.generate_neighbors(CUTOFF)
+    p, _ = voronoi_3d.candidates(model, model.atoms[0], CUTOFF)
+    messages = []
+    for engine in ('python', 'numpy'):
+        with pytest.raises(voronoi_3d.MyError) as error:
+            voronoi_3d.engines[engine](len(p), TOL, p)
+        messages.append(str(error.value))
+    assert messages[0] == messages[1]
+    # Too few candidates to enclose the atom
+    for engine in ('python', 'numpy'):
+        with pytest.raises(voronoi_3d.MyError) as error:
+            voronoi_3d.engines[engine](3, TOL, p[:3])
+        messages.append(str(error.value))
+    assert messages[2] == messages[3]
+
+
+def test_face_index_beyond_nv():
+    # A 2x2x10 box cell: the four (1,1,0) candidates are closer than the +-z faces but
+    # don't touch the cell, so the z faces are candidates 8 and 9 while nv is 8
+    r = [(2,0,0),(-2,0,0),(0,2,0),(0,-2,0),(2.5,2.5,0),(2.5,-2.5,0),(-2.5,2.5,0),(-2.5,-2.5,0),(0,0,10),(0,0,-10)]
+    p = [[x,y,z,x*x+y*y+z*z] for x,y,z in r]
+    ref, new = outcome('python', p), outcome('numpy', p)
+    assert ref[:4] == new[:4] == (8, 6, 12, [3,3,3,3,-1,-1,-1,-1,3,3])
+    assert np.allclose(ref[4], new[4])
+    for engine in ('python', 'numpy'):
+        nedges, nnab, nablst, vol = voronoi_3d.polyhedron(p, list(range(len(p))), engine=engine)
+        assert (nnab, nablst) == (6, [0,1,2,3,8,9])
+        assert np.isclose(vol, 40.0)
+
+
+def test_voronoi_3d_engine():
+    results = []
+    for engine in ('python', 'numpy'):
+        model = fcc_model(noise=0.1, seed=2)
+        voronoi_3d.voronoi_3d(model, CUTOFF, cache=False, engine=engine)
+        results.append(([atom.vp.index for atom in model.atoms], [atom.vp.vol for atom in model.atoms]))
+    assert results[0][0] == results[1][0]
+    assert np.allclose(results[0][1], results[1][1], rtol=1e-12)
+
+
+def test_triclinic_cell():
+    # The candidates must use the minimum image of the tilted cell, see _candidates
+    import voronoi_scipy
+    fcc = fcc_model(n=4, noise=0.05, seed=4)
+    L = fcc.xsize
+    cell = np.array([[L,0,0],[.3*L,L,0],[.1*L,.2*L,L]])
+    model = Model.from_arrays(fcc.znums, (fcc.fractional(fcc.positions) - 0.5).dot(cell), cell=cell)
+    voronoi_3d.voronoi_3d(model, 5.0)
+    volumes = [atom.vp.vol for atom in model.atoms]
+    assert np.isclose(sum(volumes), abs(np.linalg.det(cell)))
+    reference = voronoi_scipy.tessellate(model)
+    assert [tuple(atom.vp.index) for atom in model.atoms] == [tuple(x) for x in reference.index.tolist()]
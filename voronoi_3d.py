@@ -3,7 +3,12 @@ import os
 import random
 import math,time
 import numpy as np
-from model import Model
+import vp_cache
+
+try:
+    xrange
+except NameError:
+    xrange = range
 
 
 class MyError(Exception):
@@ -16,68 +21,170 @@ def frac(atom,model):
     # Returns the coordinate of atom in fractional coordinates between 0 and 1
     return (atom.coord[0]/model.xsize+0.5, atom.coord[1]/model.ysize+0.5, atom.coord[2]/model.zsize+0.5)
 
-def voronoi_3d(model,cutoff):
+def voronoi_3d(model,cutoff,nprocs=1,backend='voronoi_3d',cache=None,engine='numpy'):
+    """ Computes the VP of every atom. backend='scipy' uses the whole-box tessellation
+        in voronoi_scipy instead of building each VP from the neighbors within cutoff.
+        engine is the vertex enumeration of the voronoi_3d backend (see calculate_atom). """
+    if backend == 'scipy':
+        import voronoi_scipy
+        voronoi_scipy.scipy_voronoi_3d(model,cutoff,cache=cache)
+        return
     atol = 0.03
     tol = 0.03
     tltol = 0.03
-    vp_anaysizesis(model,cutoff,tol,atol,tltol)
+    vp_anaysizesis(model,cutoff,tol,atol,tltol,nprocs=nprocs,engine=engine,cache=cache)
+
+
+def vp_anaysizesis(model,cutoff,tol,atol,tltol,nprocs=1,chunksize=2000,engine='numpy',cache=None):
+    """ Computes the VP of every atom. With nprocs > 1 the atoms are split into chunks of
+        chunksize that are handled by a pool of nprocs processes (see vp_parallel).
+        If cache is True, or None and VP_CACHE=1, the VPs are read from / saved to the
+        on-disk vp_cache; neighbors that were set before the call are part of the cache key.
+        A ModelView gets its own copies of the atoms first (see ModelView._detach). """
+    model._detach()
+    store = vp_cache.get_cache(cache)
+    if store is not None:
+        neighbors = None
+        if any(atom.neighs is not None for atom in model.atoms):
+            neighbors = neighbor_arrays(model)
+        key = store.key(model, cutoff, (tol, atol, tltol), 'voronoi_3d', neighbors)
+        if store.load(key, model):
+            print("Loaded the VPs from the cache: {0}".format(key))
+            return
+    if nprocs > 1:
+        vp_parallel(model, cutoff, nprocs, chunksize=chunksize, atol=atol, tol=tol, tltol=tltol, engine=engine)
+    else:
+        # model.atomtypes has integer keys, not stings
+        print_percent = 0.0
+        for i,atomi in enumerate(iter(model.atoms)):
+            #print("Calculating VP for atom {0}".format(i))
+            if(100.0*i/model.natoms > print_percent):
+                print("{0}% done...".format(print_percent))
+                print_percent += 10.0
+            calculate_atom(model, atomi, cutoff, atol=atol, tol=tol, tltol=tltol, engine=engine)
+    if store is not None:
+        store.save(key, model)
+    volume = abs(np.linalg.det(model.cell_matrix))
+    print("percentages of volume counted: {0}".format(sum(atomi.vp.vol/volume for atomi in model.atoms)))
+
+
+def vp_parallel(model, cutoff, nprocs, chunksize=2000, atol=0.03, tol=0.03, tltol=0.03, engine='numpy'):
+    """ Computes the VP of every atom with a pool of nprocs processes.
+        Each chunk of atoms is sent as arrays (the center positions and elements and the
+        positions and elements of their neighbors, in atom.neighs order), so the workers
+        never see the model. The chunks come back in order and are saved into the model
+        with save_vp_atom_data, so the result is the same as the serial calculation. """
+    import multiprocessing
+    model._detach()
+    atoms = model.atoms
+    if not all(atom.neighs for atom in atoms): model.generate_neighbors(cutoff)
+    offsets, indices = neighbor_arrays(model)
+    positions = model.positions
+    znums = model.znums
+    cell = model.cell_matrix
+    def chunks():
+        for start in xrange(0, model.natoms, chunksize):
+            end = min(start+chunksize, model.natoms)
+            nb = indices[offsets[start]:offsets[end]]
+            yield (znums[start:end], positions[start:end], offsets[start:end+1]-offsets[start],
+                   znums[nb], positions[nb], cell, cutoff, atol, tol, tltol, engine)
+    pool = multiprocessing.Pool(nprocs)
+    try:
+        start = 0
+        print_percent = 0.0
+        for results in pool.imap(_vp_chunk, chunks()):
+            for i,result in enumerate(results):
+                save_vp_atom_data(model, atoms[start+i], *result)
+            start += len(results)
+            while(100.0*start/model.natoms > print_percent):
+                print("{0}% done...".format(print_percent))
+                print_percent += 10.0
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _vp_chunk(args):
+    """ Worker for vp_parallel. Returns (nedges, nnab, nablst, vol) of every center atom. """
+    center_z, centers, offsets, znums, coords, cell, cutoff, atol, tol, tltol, engine = args
+    results = []
+    for n in xrange(len(centers)):
+        s = slice(offsets[n], offsets[n+1])
+        p, mtag = _candidates(center_z[n], centers[n], znums[s], coords[s], cell, cutoff)
+        results.append(polyhedron(p, mtag, atol, tol, tltol, engine))
+    return results
+
+
+def neighbor_arrays(model):
+    """ Returns (offsets, indices): the model index of every neighbor of atom i, in
+        atom.neighs order, is indices[offsets[i]:offsets[i+1]]. Atoms without neighbors
+        (atom.neighs is None) have none. """
+    nl = model._valid_neighbor_list()
+    if nl is not None:
+        # Same order as atom.neighs, see Model._set_neighbors
+        return nl.offsets, nl.indices
+    counts = [len(atom.neighs or []) for atom in model.atoms]
+    indices = [model._slot_of(n) for atom in model.atoms for n in (atom.neighs or [])]
+    offsets = np.concatenate(([0], np.cumsum(counts))).astype(int)
+    return offsets, np.array(indices, dtype=int)
 
 
-def vp_anaysizesis(model,cutoff,tol,atol,tltol):
-    atom_vol = np.zeros(model.natoms)
-    # model.atomtypes has integer keys, not stings
-    print_percent = 0.0
-    for i,atomi in enumerate(iter(model.atoms)):
-        #print("Calculating VP for atom {0}".format(i))
-        if(100.0*i/model.natoms > print_percent):
-            print("{0}% done...".format(print_percent))
-            print_percent += 10.0
-        calculate_atom(model, atomi, cutoff, atol=atol, tol=tol, tltol=tltol)
-    print("percentages of volume counted: {0}".format(sum(atomi.vp.vol/(model.xsize*model.ysize*model.zsize) for atomi in model.atoms)))
+def candidates(model, atom, cutoff):
+    """ Returns (p, mtag) for atom: p holds [rx, ry, rz, r^2] of every neighbor within cutoff
+        (minimum image) and mtag its position in atom.neighs, both sorted by r^2. """
+    coords = np.array([atomj.coord for atomj in atom.neighs], dtype=float).reshape((-1,3))
+    znums = np.array([atomj.z for atomj in atom.neighs], dtype=int)
+    return _candidates(atom.z, atom.coord, znums, coords, model.cell_matrix, cutoff)
 
 
-def calculate_atom(model, atom, cutoff, atol=0.03, tol=0.03, tltol=0.03):
+def _candidates(z, coord, znums, coords, cell, cutoff):
+    """ candidates() for the neighbors of an atom of element z at coord given as arrays.
+        cell is the 3x3 cell matrix of the model (see Model.cell_matrix). """
+    cell = np.asarray(cell, dtype=float)
+    coord = np.asarray(coord, dtype=float)
+    if np.count_nonzero(cell - np.diag(np.diag(cell))) == 0:
+        box = np.diag(cell)
+        r = coords/box - coord/box
+        r = r - np.round(r) #PBCs
+        r = r*box
+    else:
+        # Triclinic cell, minimum image in fractional coordinates as in Model.minimum_image
+        r = (coords - coord).dot(np.linalg.inv(cell))
+        r = r - np.round(r)
+        r = r.dot(cell)
+    # Weighted voronoi anaysizesis would scale r by 2*w[z]/(w[z]+w[zj]); all weights are 1
+    rsq = r[:,0]**2 + r[:,1]**2 + r[:,2]**2
+    # Select all atoms within cutoff of atom, cutoff is based on species
+    try:
+        thiscut = np.array([cutoff[(z,zj)] for zj in znums.tolist()], dtype=float)
+    except TypeError:
+        thiscut = cutoff
+    mtag = np.flatnonzero(rsq < thiscut**2)
+    # Sort mtag and p
+    mtag = mtag[np.argsort(rsq[mtag], kind='mergesort')]
+    p = np.column_stack((r[mtag], rsq[mtag]))
+    return p.tolist(), mtag.tolist()
+
+
+def calculate_atom(model, atom, cutoff, atol=0.03, tol=0.03, tltol=0.03, engine='numpy'):
+    """ Computes the VP of atom from its neighbors within cutoff. engine picks the
+        vertex enumeration: 'numpy' (work_numpy) or 'python' (work). """
+    _check_owned(model)
     if(not atom.neighs): model.generate_neighbors(cutoff)
-    vol = 0.0
-    weight_sp = model.atomtypes.copy()
-    for key in weight_sp:
-        weight_sp[key] = 1.0
-    p = []
-    mtag = []
-    for j,atomj in enumerate(atom.neighs):
-        #if(i == j): continue
-        rxij = atomj.coord[0]/model.xsize - atom.coord[0]/model.xsize
-        ryij = atomj.coord[1]/model.ysize - atom.coord[1]/model.ysize
-        rzij = atomj.coord[2]/model.zsize - atom.coord[2]/model.zsize
-        rxij = rxij - round(rxij) #PBCs
-        ryij = ryij - round(ryij)
-        rzij = rzij - round(rzij)
-        # These four lines implement weighted voronoi anaysizesis
-        ratio = 2*weight_sp[atom.z]/(weight_sp[atom.z]+weight_sp[atomj.z])
-        rxij=rxij*ratio*model.xsize
-        ryij=ryij*ratio*model.ysize
-        rzij=rzij*ratio*model.zsize
-        rijsq = rxij**2 + ryij**2 + rzij**2
-        # Select all atoms within cutoff of atom, cutoff is based on species
-        try:
-            thiscut = cutoff[(atom.z,atomj.z)]
-            if(rijsq < thiscut**2):
-                p.append([rxij, ryij, rzij, rijsq])
-                mtag.append(j) #???
-        except TypeError:
-            if(rijsq < cutoff**2):
-                p.append([rxij, ryij, rzij, rijsq])
-                mtag.append(j) #???
+    p, mtag = candidates(model, atom, cutoff)
+    nedges, nnab, nablst, vol = polyhedron(p, mtag, atol, tol, tltol, engine)
+    save_vp_atom_data(model, atom, nedges, nnab, nablst, vol)
+
 
+def polyhedron(p, mtag, atol=0.03, tol=0.03, tltol=0.03, engine='numpy'):
+    """ Builds the VP from the candidates (p, mtag) of an atom.
+        Returns (nedges, nnab, nablst, vol) for save_vp_atom_data. """
+    vol = 0.0
     # Candidates have been selected
     nc = len(p)
-    #print("Sorting mtag and p")
-    # Sort mtag and p
-    mtag = [x for (y,x) in sorted(zip(p,mtag),key=lambda x: x[0][3])]
-    p.sort(key=lambda x: x[3])
     #print("Calling work")
     try:
-        nv,nf,ne,nepf,nloop,mvijk,v = work(nc,tol,p)
+        nv,nf,ne,nepf,nloop,mvijk,v = engines[engine](nc,tol,p)
         good = True
     except MyError as inst:
         good = False
@@ -199,7 +306,7 @@ def calculate_atom(model, atom, cutoff, atol=0.03, tol=0.03, tltol=0.03):
                 nablst.append(0)
                 nablst[nnab-1] = mtag[ic]
     nedges = [x for x in nedges if x != 0]
-    save_vp_atom_data(model, atom, nedges, nnab, nablst, vol)
+    return nedges, nnab, nablst, vol
 
 
 def work(nc,tol,p):
@@ -253,7 +360,8 @@ def work(nc,tol,p):
     if(nv < 4): raise MyError("Less than 4 vertices found in work: {0}".format(nv))
 
     nepf = [0]*nc # Number of edges per face
-    nloop = np.zeros((75,nv),dtype=int).tolist() # ??? Change 75 to something more concrete, or use append somehow
+    # nloop[n][ic] is the n'th vertex on face ic; a face has at most nv vertices and ic goes up to nc
+    nloop = np.zeros((nv,nc),dtype=int).tolist()
     # This seems strange but I'm okay with it I think.
     for iv in xrange(0,nv):
         # This is done in fortran
@@ -278,35 +386,146 @@ def work(nc,tol,p):
     #End of work()
 
 
+_triples = {}
+def triples(nc):
+    """ (ntriples,3) array of every i < j < k below nc, in the order work visits them,
+        and i*nc+j of every triple. """
+    if nc not in _triples:
+        i, j, k = np.meshgrid(np.arange(nc), np.arange(nc), np.arange(nc), indexing='ij')
+        keep = (i < j) & (j < k)
+        ijk = np.column_stack((i[keep], j[keep], k[keep]))
+        _triples[nc] = (ijk, ijk[:,0]*nc + ijk[:,1])
+    return _triples[nc]
+
+
+def work_numpy(nc,tol,p,block=16):
+    """ Same as work, with the loops done in numpy: every (i,j,k) plane intersection is
+        solved at once, the vertices are tested against the half-spaces with broadcasts
+        over blocks of connections, and the face loops are built by sorting the vertices by face.
+        The arithmetic is done in the same order as in work, so the results are identical.
+        returns (nv,nf,ne,nepf,nloop,mvijk,v) """
+    if(nc < 4): raise MyError("Less than 4 points given to work: {0}".format(nc))
+    p = np.asarray(p, dtype=float).reshape((-1,4))
+    a, b, c, d = p[:,0], p[:,1], p[:,2], -p[:,3]
+    # ab[i,j] = a[i]*b[j] - a[j]*b[i] etc. for every pair, looked up by i*nc+j
+    def cross(x, y):
+        xy = np.multiply.outer(x, y)
+        return (xy - xy.T).ravel()
+    ab, bc, ca = cross(a, b), cross(b, c), cross(c, a)
+    da, db, dc = cross(d, a), cross(d, b), cross(d, c)
+    ijk, ij = triples(nc)
+    k = ijk[:,2]
+    det = a[k] * bc[ij] + b[k] * ca[ij] + c[k] * ab[ij]
+    solvable = np.flatnonzero(np.abs(det) > tol)
+    ijk, ij, det = ijk[solvable], ij[solvable], det[solvable]
+    i, j, k = ijk[:,0], ijk[:,1], ijk[:,2]
+    ab, bc, ca, da, db, dc = ab[ij], bc[ij], ca[ij], da[ij], db[ij], dc[ij]
+    detinv = 1.0 / det
+    vx = ( - d[k] * bc + b[k] * dc - c[k] * db ) * detinv
+    vy = ( - a[k] * dc - d[k] * ca + c[k] * da ) * detinv
+    vz = (   a[k] * db - b[k] * da - d[k] * ab ) * detinv
+    # A vertex is kept if it is inside the half-space of every other connection. The
+    # connections are sorted by distance, so most vertices are rejected by the first few
+    # and the test is done block by block on the vertices that are still left.
+    ok = np.arange(len(ijk))
+    for start in xrange(0, nc, block):
+        end = min(start+block, nc)
+        x, y, z = vx[ok], vy[ok], vz[ok]
+        # inside[l,n] for connection start+l and vertex ok[n]
+        inside = (a[start:end,None]*x + b[start:end,None]*y + c[start:end,None]*z) <= p[start:end,3,None]
+        # i, j and k themselves are not checked
+        for l in (i[ok], j[ok], k[ok]):
+            own = np.flatnonzero((l >= start) & (l < end))
+            inside[l[own]-start, own] = True
+        ok = ok[inside.all(axis=0)]
+    mvijk = ijk[ok]
+    v = 0.5*np.column_stack((vx[ok], vy[ok], vz[ok]))
+    nv = len(mvijk)
+    if(nv < 4): raise MyError("Less than 4 vertices found in work: {0}".format(nv))
+
+    # nloop[n][ic] is the n'th vertex (in order) on face ic
+    faces = mvijk.ravel()
+    counts = np.bincount(faces, minlength=nc)
+    order = np.argsort(faces, kind='mergesort')
+    starts = np.cumsum(counts) - counts
+    rank = np.empty(len(faces), dtype=int)
+    rank[order] = np.arange(len(faces)) - starts[faces[order]]
+    nloop = np.zeros((nv,nc),dtype=int) # Same size as in work
+    nloop[rank, faces] = np.arange(len(faces))//3
+
+    nf = int(np.count_nonzero(counts))
+    ne = int(counts.sum())
+    if( ne%2 != 0): raise MyError("Something got screwed up in work! {0}".format(ne))
+    ne = ne/2
+
+    nepf = (counts-1).tolist()
+
+    if(nv-ne+nf != 2):
+        raise MyError("Bad atom!")
+    return (nv,nf,ne,nepf,nloop.tolist(),mvijk.tolist(),v.tolist())
+
+engines = {'python': work, 'numpy': work_numpy}
+
+
+def compare_engines(model, cutoff, tol=0.03, engine='numpy', reference='python'):
+    """ Runs two work engines on the candidates of every atom in model (which needs
+        neighbors) and raises an Exception at the first atom where they disagree:
+        the topology must be identical and the vertices equal within tol.
+        Returns the number of atoms compared. """
+    for atom in model.atoms:
+        p, mtag = candidates(model, atom, cutoff)
+        results = []
+        for name in (reference, engine):
+            try:
+                results.append(engines[name](len(p),tol,p))
+            except MyError as inst:
+                results.append(str(inst))
+        ref, new = results
+        if isinstance(ref, str) or isinstance(new, str):
+            same = ref == new
+        else:
+            same = ref[:6] == new[:6] and np.allclose(ref[6], new[6], rtol=0.0, atol=tol)
+        if not same:
+            raise Exception("Engines {0} and {1} disagree for atom {2}".format(reference, engine, atom))
+    return model.natoms
+
+
+def _check_owned(model):
+    """ Raises if the atoms of model belong to another model (a ModelView that still shares
+        its parent's atoms), so that their VPs would be written into the parent. """
+    if getattr(model, 'parent', None) is not None:
+        raise Exception("The atoms of this view belong to its parent model. Use view.voronoi() or vp_anaysizesis, which copy them first, or materialize() the view.")
+
+
 def save_vp_atom_data(model,atomi,nedges,nnab,nablst,atom_vol):
     nnabsp = {}
     for key in model.atomtypes:
         nnabsp[key] = 0
-    atomi.vp.index = [0,0,0,0,0,0,0,0]
+    index = [0,0,0,0,0,0,0,0] # Built as a list, atomi.vp may store it as a tuple
 
     for j in xrange(0,len(nedges)):
         if(nedges[j] > 0):
             nnabsp[model.atoms[nablst[j]].z] += 1
             # nedges is one off, thats why we start at 2 and not 3
             if(nedges[j] == 2):
-                atomi.vp.index[0] += 1
+                index[0] += 1
             elif(nedges[j] == 3):
-                atomi.vp.index[1] += 1
+                index[1] += 1
             elif(nedges[j] == 4):
-                atomi.vp.index[2] += 1
+                index[2] += 1
             elif(nedges[j] == 5):
-                atomi.vp.index[3] += 1
+                index[3] += 1
             elif(nedges[j] == 6):
-                atomi.vp.index[4] += 1
+                index[4] += 1
             elif(nedges[j] == 7):
-                atomi.vp.index[5] += 1
+                index[5] += 1
             elif(nedges[j] == 8):
-                atomi.vp.index[6] += 1
+                index[6] += 1
             elif(nedges[j] == 9):
-                atomi.vp.index[7] += 1
+                index[7] += 1
             elif(nedges[j] == 10):
-                atomi.vp.index[8] += 1
-    atomi.vp.index = tuple(atomi.vp.index)
+                index[8] += 1
+    atomi.vp.index = tuple(index)
 
     nablst = [model.atoms[x] for x in nablst]
     atomi.vp.nnabsp = nnabsp
@@ -343,6 +562,7 @@ def main():
     # NOTE: Cutoff can either be a single integer or it
     # can be a dictionary where the keys are two-tuples
     # of atomic numbers (e.g. (40,13)=3.5 for Zr,Al).
+    from model import Model
     modelfile = sys.argv[1]
     m = Model(modelfile)
     try:
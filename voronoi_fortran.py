@@ -4,12 +4,26 @@ import random
 import string
 import subprocess
 from model import Model
+import vp_cache
 
-def fortran_voronoi_3d(modelfile,cutoff):
+# The vorv4 executable; set $VORV4 to use another one
+VORV4 = os.environ.get('VORV4', '/home/maldonis/model_analysis/scripts/working/vorv4')
+
+def fortran_voronoi_3d(modelfile,cutoff,cache=None):
+        model = Model(modelfile)
+        store = vp_cache.get_cache(cache)
+        if store is not None:
+            key = store.key(model, cutoff, backend='fortran')
+            if store.load(key, model):
+                for atom in model.atoms:
+                    atom.vp.index = list(atom.vp.index)
+                    atom.cn = sum(atom.vp.index)
+                return model
         vorrun = Vor()
         vorrun.runall(modelfile,cutoff)
-        model = Model(modelfile)
         vorrun.set_atom_vp_indexes(model)
+        if store is not None:
+            store.save(key, model)
         return model
 
 def parse_index_file_line(line):
@@ -93,7 +107,7 @@ class Vor(object):
         opf.close()
 
         #p = subprocess.Popen(['/home/jjmaldonis/bin/vor',self.randstr+'.vparm',modelfile,self.randstr], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        p = subprocess.Popen(['/home/maldonis/model_analysis/scripts/working/vorv4',self.randstr+'.vparm',modelfile,self.randstr], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        p = subprocess.Popen([VORV4,self.randstr+'.vparm',modelfile,self.randstr], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         self.poutput = p.stdout.read()
         self.perr = p.stderr.read()
         self.preturncode = p.wait()
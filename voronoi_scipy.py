@@ -0,0 +1,169 @@
+import sys
+import numpy as np
+from scipy.spatial import Voronoi
+from hutch import _STENCIL
+from neighbor_list import NeighborList
+import vp_cache
+
+VP_INDEX_LENGTH = 8 # <n3,n4,...,n10>, as in voronoi_3d
+
+
+class Tessellation(object):
+    """ Periodic Voronoi tessellation of a whole model, computed in one call to qhull.
+        The atoms and the periodic images within 'pad' of the box are tessellated together,
+        which gives the exact Voronoi cells of the atoms in the box as long as pad is larger
+        than the cells (the default is 3 times the mean atomic spacing).
+        Results are arrays, one entry per atom:
+            index   (natoms,8) VP index <n3,n4,...,n10>; faces with more edges are not counted
+            volume  (natoms,) cell volumes
+        and one entry per face of every cell, sorted by atom (see neighbor_list):
+            i, j    the atom and its neighbor across the face
+            areas   face areas
+            edges   number of edges of the face
+            distances  distance between i and j """
+
+    def __init__(self, model, pad=None):
+        natoms = model.natoms
+        cell = model.cell_matrix
+        volume = abs(np.linalg.det(cell))
+        if pad is None:
+            pad = 3.0*(volume/natoms)**(1.0/3.0)
+        # Distance between opposite faces of the box
+        widths = volume/np.linalg.norm(np.cross(cell[[1,2,0]], cell[[2,0,1]]), axis=1)
+        margin = pad/widths
+        frac = np.mod(model.fractional(model.positions), 1.0)
+        # The atoms themselves come first, then the images near the box
+        points, owners = [frac], [np.arange(natoms)]
+        for shift in _STENCIL:
+            if not shift.any():
+                continue
+            f = frac + shift
+            keep = np.flatnonzero(np.all((f >= -margin) & (f < 1.0+margin), axis=1))
+            points.append(f[keep])
+            owners.append(keep)
+        points = (np.concatenate(points) - 0.5).dot(cell)
+        owners = np.concatenate(owners)
+        vor = Voronoi(points)
+
+        # Faces of the atoms in the box
+        rp = vor.ridge_points
+        ridges = np.flatnonzero((rp < natoms).any(axis=1))
+        nverts = np.array([len(vor.ridge_vertices[r]) for r in ridges.tolist()], dtype=int)
+        verts = np.fromiter((v for r in ridges.tolist() for v in vor.ridge_vertices[r]), dtype=int, count=int(nverts.sum()))
+        if (verts < 0).any():
+            raise Exception("A Voronoi cell in the box is not closed, increase pad (now {0}).".format(pad))
+        areas = _polygon_areas(vor.vertices[verts], nverts, points[rp[ridges,1]] - points[rp[ridges,0]])
+
+        # Every face belongs to each of its two atoms that are in the box
+        a, b = rp[ridges,0], rp[ridges,1]
+        ina, inb = a < natoms, b < natoms
+        i = np.concatenate((a[ina], b[inb]))
+        j = np.concatenate((owners[b[ina]], owners[a[inb]]))
+        d = np.linalg.norm(points[b] - points[a], axis=1)
+        face = np.concatenate((np.flatnonzero(ina), np.flatnonzero(inb)))
+        order = np.lexsort((j, i))
+        self.natoms = natoms
+        self.pad = pad
+        self.i, self.j = i[order], j[order]
+        face = face[order]
+        self.areas, self.edges, self.distances = areas[face], nverts[face], d[face]
+        self.offsets = np.searchsorted(self.i, np.arange(natoms+1))
+
+        # The pyramid on each face has height d/2
+        self.volume = np.bincount(self.i, weights=self.areas*self.distances/6.0, minlength=natoms)
+        counted = (self.edges >= 3) & (self.edges < 3+VP_INDEX_LENGTH)
+        self.index = np.bincount(self.i[counted]*VP_INDEX_LENGTH + self.edges[counted]-3,
+                                 minlength=natoms*VP_INDEX_LENGTH).reshape((natoms,VP_INDEX_LENGTH))
+
+    def neighbor_list(self):
+        """ The Voronoi neighbors of every atom as a NeighborList. """
+        return NeighborList.from_pairs(self.natoms, self.i, self.j, self.distances)
+
+    def apply(self, model):
+        """ Sets atom.vp.index, vol, neighs and nnabsp of every atom in model, like
+            voronoi_3d.save_vp_atom_data. A ModelView gets its own copies of the atoms first. """
+        model._detach()
+        atoms = model.atoms
+        types = sorted(model.atomtypes)
+        znums = model.znums
+        nnabsp = np.zeros((self.natoms, len(types)), dtype=int)
+        np.add.at(nnabsp, (self.i, np.searchsorted(types, znums[self.j])), 1)
+        index = self.index.tolist()
+        volume = self.volume.tolist()
+        nnabsp = nnabsp.tolist()
+        j = self.j.tolist()
+        offsets = self.offsets.tolist()
+        for n,atom in enumerate(atoms):
+            vp = atom.vp
+            vp.index = tuple(index[n])
+            vp.vol = volume[n]
+            vp.neighs = [atoms[x] for x in j[offsets[n]:offsets[n+1]]]
+            vp.nnabsp = dict(zip(types, nnabsp[n]))
+
+
+def _polygon_areas(vertices, nverts, normals):
+    """ Areas of convex polygons given as consecutive runs of nverts[k] vertices (in any
+        order) with normal vectors normals[k]. The vertices of each polygon are sorted by
+        angle around their centroid before the area is summed up. """
+    npoly = len(nverts)
+    poly = np.repeat(np.arange(npoly), nverts)
+    starts = np.cumsum(nverts) - nverts
+    centroids = np.add.reduceat(vertices, starts, axis=0)/nverts[:,None]
+    n = normals/np.linalg.norm(normals, axis=1)[:,None]
+    # Two unit vectors in the plane of each polygon
+    helper = np.where(np.abs(n[:,[0]]) < 0.9, [[1.0,0.0,0.0]], [[0.0,1.0,0.0]])
+    u = np.cross(n, helper)
+    u /= np.linalg.norm(u, axis=1)[:,None]
+    v = np.cross(n, u)
+    r = vertices - centroids[poly]
+    angle = np.arctan2(np.einsum('ij,ij->i', r, v[poly]), np.einsum('ij,ij->i', r, u[poly]))
+    order = np.lexsort((angle, poly))
+    r = r[order]
+    # The next vertex around each polygon
+    following = np.arange(len(r)) + 1
+    last = starts + nverts - 1
+    following[last] = starts
+    cross = np.einsum('ij,ij->i', np.cross(r, r[following]), n[poly])
+    return 0.5*np.abs(np.bincount(poly, weights=cross, minlength=npoly))
+
+
+def tessellate(model, pad=None):
+    """ Returns the periodic Voronoi Tessellation of model. """
+    return Tessellation(model, pad)
+
+
+def scipy_voronoi_3d(model, cutoff=None, cache=None):
+    """ Drop-in replacement for voronoi_3d.voronoi_3d and voronoi_fortran.fortran_voronoi_3d:
+        sets the VP of every atom from one periodic tessellation and returns the model.
+        model can be a Model or a model file. The tessellation needs no cutoff; if one
+        is given the largest value is used as the padding of periodic images.
+        If cache is True, or None and VP_CACHE=1, the VPs are read from / saved to the
+        on-disk vp_cache. """
+    if isinstance(model, str):
+        from model import Model
+        model = Model(model)
+    model._detach()
+    pad = None
+    if cutoff is not None:
+        pad = max(cutoff.values()) if isinstance(cutoff, dict) else float(cutoff)
+    store = vp_cache.get_cache(cache)
+    if store is not None:
+        key = store.key(model, pad, backend='scipy')
+        if store.load(key, model):
+            return model
+    Tessellation(model, pad).apply(model)
+    if store is not None:
+        store.save(key, model)
+    return model
+
+
+def main():
+    from model import Model
+    m = Model(sys.argv[1])
+    t = tessellate(m)
+    for n in range(m.natoms):
+        print("{0}\t{1}\t{2}\t{3}".format(m.atoms[n].id, m.atoms[n].z, tuple(t.index[n]), t.volume[n]))
+    print("percentages of volume counted: {0}".format(t.volume.sum()/abs(np.linalg.det(m.cell_matrix))))
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,9 @@
 from subproc import run_subproc
 from collections import Counter
+import numpy as np
+from scipy.spatial import HalfspaceIntersection
+
+WALL = 1000.0 # The container of voronoi.cc goes from -1000 to 1000 in x, y and z
 
 def compute_index(filename):
     """The atom for which the VP index should be calculated must be on the last line of the file."""
@@ -10,6 +14,62 @@ def compute_index(filename):
     index = tuple(index[i] for i in range(3,13))
     return index
 
+
+def face_orders(positions, tol=1e-8):
+    """ Returns the number of edges of every face of the Voronoi cell of the last atom in
+        positions, computed in-process. As in voronoi.cc the cell is clipped by the walls
+        of a container from -1000 to 1000. tol is relative to the size of the cluster. """
+    positions = np.asarray(positions, dtype=float).reshape((-1,3))
+    center = positions[-1]
+    r = positions[:-1] - center
+    r = r[np.einsum('ij,ij->i', r, r) > 0]
+    # The half-spaces r.x <= |r|^2/2 (x relative to the center) and the walls
+    walls = np.vstack((np.eye(3), -np.eye(3)))
+    normals = np.vstack((r, walls))
+    offsets = np.concatenate((-0.5*np.einsum('ij,ij->i', r, r), -(WALL - walls.dot(center))))
+    scale = max(np.abs(r).max() if len(r) else 0.0, 1.0)
+    hs = HalfspaceIntersection(np.column_stack((normals, offsets)), np.zeros(3))
+    # Vertices where more than three planes meet show up once per triple of planes
+    vertices = hs.intersections
+    _, first = np.unique(np.round(vertices/(tol*scale)), axis=0, return_index=True)
+    vertices = vertices[np.sort(first)]
+    # A face is a plane with at least three vertices on it
+    lengths = np.sqrt(np.einsum('ij,ij->i', normals, normals))
+    distance = (vertices.dot(normals.T) + offsets)/lengths
+    counts = np.count_nonzero(np.abs(distance) <= tol*scale, axis=0)
+    return counts[counts >= 3]
+
+
+def cluster_index(positions):
+    """ Same as compute_index, for a cluster given as an (natoms,3) array with the
+        center last, without running voronoi. """
+    index = Counter(face_orders(positions).tolist())
+    return tuple(index[i] for i in range(3,13))
+
+
+def _cluster_indexes(clusters):
+    return [cluster_index(positions) for positions in clusters]
+
+
+def compute_indexes(clusters, nprocs=1, chunksize=1000):
+    """ VP indexes (as in compute_index) of many clusters at once. Each cluster is an
+        (natoms,3) array of positions with the center atom last. With nprocs > 1 the
+        clusters are split into chunks of chunksize handled by a pool of processes;
+        the indexes are returned in the order of the clusters either way. """
+    clusters = [np.asarray(positions, dtype=float) for positions in clusters]
+    if nprocs <= 1:
+        return _cluster_indexes(clusters)
+    import multiprocessing
+    chunks = [clusters[i:i+chunksize] for i in range(0, len(clusters), chunksize)]
+    pool = multiprocessing.Pool(nprocs)
+    try:
+        results = pool.map(_cluster_indexes, chunks)
+    finally:
+        pool.close()
+        pool.join()
+    return [index for chunk in results for index in chunk]
+
+
 def main():
     import sys
     index = compute_index(sys.argv[1])
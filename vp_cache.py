@@ -0,0 +1,169 @@
+""" On-disk cache of Voronoi results.
+    Entries are keyed by a hash of everything the VPs depend on (positions, elements, box,
+    cutoff, tolerances, backend and any neighbors that were set beforehand) and hold the VP
+    index, volume and Voronoi neighbors of every atom, and atom.neighs if it was set, as a
+    compressed npz file. The least recently used entries are deleted when the cache grows
+    past its size limit.
+    The cache is off unless asked for: VP_CACHE=1 turns it on for every caller of
+    voronoi_3d, voronoi_scipy, voronoi_fortran and CutoffSweep.voronoi, and cache=True
+    turns it on for one call (cache=False turns it off). The default cache lives in
+    $VP_CACHE_DIR (~/.cache/model_analysis/vp if unset) and is limited to $VP_CACHE_BYTES
+    bytes (1 GB); VP_CACHE=0 turns it off even for cache=True. """
+import os
+import hashlib
+import numpy as np
+
+VERSION = 2 # Change when the stored data or its meaning changes
+
+
+class VPCache(object):
+    def __init__(self, directory, max_bytes=2**30, max_entries=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+
+    def key(self, model, cutoff, tolerances=None, backend='voronoi_3d', neighbors=None):
+        """ Returns the hex key of the VPs of model computed with these parameters.
+            neighbors are the (offsets, indices) arrays of the neighbors the VPs are built
+            from (see voronoi_3d.neighbor_arrays) if they were not generated from cutoff. """
+        sha1 = hashlib.sha1()
+        sha1.update('{0} {1} {2}'.format(VERSION, backend, model.natoms).encode())
+        sha1.update(np.ascontiguousarray(model.positions, dtype=np.float64).tobytes())
+        sha1.update(np.ascontiguousarray(model.znums, dtype=np.int64).tobytes())
+        sha1.update(np.ascontiguousarray(model.cell_matrix, dtype=np.float64).tobytes())
+        if isinstance(cutoff, dict):
+            cutoff = sorted((tuple(int(z) for z in k), float(r)) for k,r in cutoff.items())
+        elif cutoff is not None:
+            cutoff = float(cutoff)
+        sha1.update(repr(cutoff).encode())
+        sha1.update(repr(None if tolerances is None else tuple(float(t) for t in tolerances)).encode())
+        if neighbors is not None:
+            sha1.update(b'neighbors')
+            for x in neighbors:
+                sha1.update(np.ascontiguousarray(x, dtype=np.int64).tobytes())
+        return sha1.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def load(self, key, model):
+        """ Sets atom.vp (index, vol, neighs, nnabsp) of every atom of model from the
+            entry 'key'. If the entry has atom.neighs and some atom of model has no
+            neighbors, atom.neighs and atom.cn are set as well, as the calculation would.
+            Returns False, and leaves the model alone, if there is no entry. """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = np.load(f)
+                index, vol = data['index'], data['vol']
+                offsets, neighs = data['offsets'], data['neighs']
+                if 'atom_offsets' in data.files:
+                    atom_offsets, atom_neighs = data['atom_offsets'].tolist(), data['atom_neighs'].tolist()
+                else:
+                    atom_offsets = None
+        except (IOError, OSError, KeyError, ValueError):
+            return False
+        if len(index) != model.natoms:
+            return False
+        try:
+            os.utime(path, None) # Marks the entry as recently used
+        except OSError:
+            pass
+        atoms = model.atoms
+        types = sorted(model.atomtypes)
+        index = index.tolist()
+        vol = vol.tolist()
+        offsets = offsets.tolist()
+        neighs = neighs.tolist()
+        for n,atom in enumerate(atoms):
+            vp = atom.vp
+            vp.index = tuple(index[n])
+            vp.vol = vol[n]
+            vp.neighs = [atoms[x] for x in neighs[offsets[n]:offsets[n+1]]]
+            nnabsp = dict((z,0) for z in types)
+            for neigh in vp.neighs:
+                nnabsp[neigh.z] += 1
+            vp.nnabsp = nnabsp
+        if atom_offsets is not None and not all(atom.neighs for atom in atoms):
+            for n,atom in enumerate(atoms):
+                atom.neighs = [atoms[x] for x in atom_neighs[atom_offsets[n]:atom_offsets[n+1]]]
+                atom.cn = len(atom.neighs)
+        return True
+
+    def save(self, key, model):
+        """ Stores the VPs of model, and atom.neighs if every atom has it, as the entry
+            'key' and trims the cache. """
+        atoms = model.atoms
+        index = np.array([atom.vp.index for atom in atoms], dtype=np.int16).reshape((model.natoms,-1))
+        vol = np.array([atom.vp.vol for atom in atoms], dtype=float)
+        neighs = [[model._slot_of(x) for x in (atom.vp.neighs or [])] for atom in atoms]
+        offsets = np.concatenate(([0], np.cumsum([len(x) for x in neighs]))).astype(np.int64)
+        neighs = np.array([x for row in neighs for x in row], dtype=np.int32)
+        extra = {}
+        if all(atom.neighs is not None for atom in atoms):
+            rows = [[model._slot_of(x) for x in atom.neighs] for atom in atoms]
+            extra['atom_offsets'] = np.concatenate(([0], np.cumsum([len(x) for x in rows]))).astype(np.int64)
+            extra['atom_neighs'] = np.array([x for row in rows for x in row], dtype=np.int32)
+        path = self._path(key)
+        tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(tmp, 'wb') as f:
+                np.savez_compressed(f, index=index, vol=vol, offsets=offsets, neighs=neighs, **extra)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            return # e.g. read-only directory; the cache is optional
+        self.trim()
+
+    def entries(self):
+        """ Returns [(mtime, size, path)] of the entries, least recently used first. """
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return entries
+        for name in names:
+            if not name.endswith('.npz'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        return entries
+
+    def trim(self):
+        """ Deletes the least recently used entries until the cache fits its limits. """
+        entries = self.entries()
+        total = sum(size for _,size,_ in entries)
+        while entries and (total > self.max_bytes or
+                           (self.max_entries is not None and len(entries) > self.max_entries)):
+            _, size, path = entries.pop(0)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for _,_,path in self.entries():
+            os.remove(path)
+
+
+def default_cache():
+    """ Returns the VPCache configured by the environment, or None if it is turned off. """
+    if os.environ.get('VP_CACHE', '1') == '0':
+        return None
+    directory = os.environ.get('VP_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'model_analysis', 'vp'))
+    return VPCache(directory, int(os.environ.get('VP_CACHE_BYTES', 2**30)))
+
+
+def get_cache(cache=None):
+    """ Returns the VPCache for the cache argument of the Voronoi functions, or None:
+        cache=None uses the default cache if VP_CACHE=1, True uses it and False doesn't. """
+    if cache is None:
+        cache = os.environ.get('VP_CACHE') == '1'
+    return default_cache() if cache else None